@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the exile hot paths, run against the YKOATH emulator with a configurable per-APDU latency. Cases that
+need pcsc-lite or botocore are skipped when those are not available.
+
+Reports ops/sec, p50/p99 latency and memory allocated per operation, and writes the results to a JSON file. With
+``--compare``, exits with a non-zero status if any case got slower than a previous results file by more than
+``--threshold``.
+"""
+import os, sys, json, time, argparse, platform, tracemalloc, datetime, collections, tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # noqa
+
+from exile import YKOATH, TOTP, SCardManager
+from exile.exceptions import ExileError
+from exile.ykoath.emulator import YKOATHEmulator
+from exile.scard.trace import RecordingTransport, ReplayTransport
+
+ACCESS_KEY, SECRET_KEY = "AKIDEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY"
+
+cases = collections.OrderedDict()  # type: collections.OrderedDict
+
+def case(fn):
+    cases[fn.__name__] = fn
+    return fn
+
+class Skip(Exception):
+    pass
+
+def make_device(args, credentials=30):
+    device = YKOATHEmulator(latency=args.latency, max_response_size=256)
+    ykoath = YKOATH(device=device, persistent=True)
+    ykoath.put("exile-{}-SigV4".format(ACCESS_KEY), b"AWS4" + SECRET_KEY.encode(), algorithm=YKOATH.Algorithm.SHA256)
+    for i in range(credentials - 1):
+        ykoath.put("totp-{:02}".format(i), b"12345678901234567890")
+    return ykoath
+
+@case
+def apdu_build(args):
+    ykoath = make_device(args)
+    ykoath.device.send_apdu = lambda cla, ins, p1, p2, data: b"\x75\x21\x06" + bytes(32) + b"\x90\x00"
+    return lambda: ykoath.calculate("exile-{}-SigV4".format(ACCESS_KEY), b"20190301", want_truncated_response=False)
+
+@case
+def tlv_parse(args):
+    ykoath = make_device(args)
+    response = ykoath.list()
+    ykoath.list = lambda: response
+    # Iterating over the session reads the cached credential index, so decode the LIST response directly
+    return lambda: list(ykoath._list_credentials())
+
+@case
+def reader_enumeration(args):
+    try:
+        manager = SCardManager()
+    except (OSError, ExileError) as e:
+        raise Skip("PC/SC unavailable: {}".format(e))
+    return lambda: list(manager)
+
+@case
+def connect_disconnect(args):
+    device = make_device(args).device
+    device.persistent = False
+
+    def run():
+        with device:
+            pass
+    return run
+
+@case
+def calculate(args):
+    ykoath = make_device(args)
+    return lambda: ykoath.calculate("exile-{}-SigV4".format(ACCESS_KEY), b"20190301", want_truncated_response=False)
+
+@case
+def calculate_per_connection(args):
+    ykoath = make_device(args)
+    ykoath.device.persistent = False
+    ykoath.device.disconnect()
+    return lambda: ykoath.calculate("exile-{}-SigV4".format(ACCESS_KEY), b"20190301", want_truncated_response=False)
+
+@case
+def calculate_replay(args):
+    fd, path = tempfile.mkstemp(suffix=".trace")
+    os.close(fd)
+    recorder = RecordingTransport(make_device(args).device, path)
+    ykoath = YKOATH(device=recorder)
+    for _ in range(args.warmup + args.iterations + min(args.iterations, 100)):
+        ykoath.calculate("exile-{}-SigV4".format(ACCESS_KEY), b"20190301", want_truncated_response=False)
+    recorder.close()
+    ykoath = YKOATH(device=ReplayTransport(path, speed=1))
+    os.unlink(path)
+    return lambda: ykoath.calculate("exile-{}-SigV4".format(ACCESS_KEY), b"20190301", want_truncated_response=False)
+
+@case
+def totp_get(args):
+    totp = TOTP(device=make_device(args).device)
+    return lambda: totp.get("totp-00")
+
+@case
+def sigv4_sign_request(args):
+    try:
+        import botocore.auth, botocore.awsrequest, botocore.credentials
+        from exile import botocore_signers
+    except ImportError as e:
+        raise Skip("botocore unavailable: {}".format(e))
+    botocore_signers.install(device=make_device(args))
+    credentials = botocore.credentials.Credentials(ACCESS_KEY, SECRET_KEY)
+
+    def run():
+        request = botocore.awsrequest.AWSRequest(method="GET", url="https://sts.amazonaws.com/",
+                                                 params={"Action": "GetCallerIdentity", "Version": "2011-06-15"})
+        botocore.auth.SigV4Auth(credentials, "sts", "us-east-1").add_auth(request)
+    return run
+
+def measure(operation, iterations, warmup):
+    for _ in range(warmup):
+        operation()
+    timings = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        t = time.perf_counter()
+        operation()
+        timings.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    timings.sort()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(min(iterations, 100)):
+            operation()
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return collections.OrderedDict([
+        ("iterations", iterations),
+        ("ops_per_sec", iterations / elapsed),
+        ("p50_us", timings[len(timings) // 2] * 1e6),
+        ("p99_us", timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e6),
+        ("retained_bytes_per_op", (after - before) / min(iterations, 100)),
+        ("peak_bytes", peak - before),
+    ])
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous or "p50_us" not in result or "p50_us" not in previous:
+            continue
+        if result["p50_us"] > previous["p50_us"] * (1 + threshold):
+            regressions.append("{}: p50 {:.1f}us -> {:.1f}us".format(name, previous["p50_us"], result["p50_us"]))
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("cases", nargs="*", help="Cases to run (default: all of {})".format(", ".join(cases)))
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated per-APDU latency in seconds")
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--output", default="bench.json", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Previous results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative p50 slowdown")
+    args = parser.parse_args(args)
+    results = collections.OrderedDict()  # type: collections.OrderedDict
+    for name in args.cases or cases:
+        try:
+            results[name] = measure(cases[name](args), args.iterations, args.warmup)
+            print("{:<28} {ops_per_sec:>12.1f} ops/s  p50 {p50_us:>10.1f}us  p99 {p99_us:>10.1f}us  "
+                  "peak {peak_bytes:>8} B".format(name, **results[name]))
+        except Skip as e:
+            results[name] = dict(skipped=str(e))
+            print("{:<28} skipped: {}".format(name, e))
+    with open(args.output, "w") as fh:
+        json.dump(dict(timestamp=datetime.datetime.utcnow().isoformat(), python=platform.python_version(),
+                       platform=platform.platform(), latency=args.latency, results=results), fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            regressions = compare(results, json.load(fh), args.threshold)
+        for regression in regressions:
+            print("Regression:", regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
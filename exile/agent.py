@@ -0,0 +1,195 @@
+"""
+A local signing agent, similar to ssh-agent. The agent owns the YubiKey and serves ``calculate`` and ``list`` requests
+from other processes over a Unix socket, so that they do not each open a PC/SC context and contend for the card.
+
+Run the agent with ``python -m exile.agent``, and point the signers at it with
+``botocore_signers.install(device=AgentClient())``.
+
+The protocol is newline-delimited JSON. Each request line is either a single request object or an array of request
+objects, which the agent executes back to back in one card transaction and answers with an array of responses.
+"""
+import os, sys, json, base64, socket, socketserver, threading, argparse, getpass, logging, typing
+from contextlib import contextmanager
+from .exceptions import ExileError, YKOATHError
+from .ykoath import YKOATH, YKOATHCredential
+
+logger = logging.getLogger(__name__)
+
+def default_socket_path():
+    if "EXILE_AGENT_SOCK" in os.environ:
+        return os.environ["EXILE_AGENT_SOCK"]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR", os.path.expanduser("~"))
+    return os.path.join(runtime_dir, ".exile-agent.sock")
+
+def _encode_error(e):
+    response = dict(error=type(e).__name__, message=str(e))
+    if e.args and isinstance(e.args[0], YKOATH.Response):
+        response["status"] = base64.b64encode(e.args[0].value).decode()
+    return response
+
+def _decode_error(response):
+    if "status" in response:
+        return YKOATHError(YKOATH.Response(base64.b64decode(response["status"])))
+    return YKOATHError(response["message"]) if response["error"] == "YKOATHError" else ExileError(response["message"])
+
+class _AgentRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+                if isinstance(request, list):
+                    try:
+                        with self.server.transaction():
+                            response = [self.server.execute(r) for r in request]  # type: typing.Any
+                    except ExileError as e:
+                        # The card could not be reserved (or released), so fail every request in the batch
+                        response = [_encode_error(e) for r in request]
+                else:
+                    response = self.server.execute(request)
+            except ValueError as e:
+                response = dict(error="ValueError", message=str(e))
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+class SigningAgent(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves requests for ``device``, which can be a ``YKOATH`` session, a ``YKOATHPool`` or any object with the same
+    ``calculate()`` method and credential iteration.
+    """
+    daemon_threads = True
+
+    def __init__(self, device, socket_path: str = None) -> None:
+        self.device = device
+        self.socket_path = socket_path or default_socket_path()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, self.socket_path, _AgentRequestHandler)
+        finally:
+            os.umask(umask)
+
+    @contextmanager
+    def transaction(self):
+        if hasattr(self.device, "transaction"):
+            with self.device.transaction():
+                yield
+        else:
+            yield
+
+    def execute(self, request):
+        try:
+            if request["op"] == "calculate":
+                truncated = request.get("truncated", True)
+                result = self.device.calculate(request["name"], base64.b64decode(request["challenge"]),
+                                               want_truncated_response=truncated)
+                return dict(result=result if truncated else base64.b64encode(result).decode())
+            elif request["op"] == "list":
+                return dict(result=[[c.name, c.oath_type.name, c.algorithm.name] for c in self.device])
+            raise ValueError("Unknown operation {}".format(request["op"]))
+        except (ExileError, KeyError, ValueError, TypeError) as e:
+            return _encode_error(e)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+class AgentClient:
+    """
+    Talks to a ``SigningAgent`` with the same ``calculate()`` and credential iteration interface as ``YKOATH``, so it
+    can be passed to ``botocore_signers.install(device=...)``. Each thread keeps its own connection to the agent.
+    """
+    def __init__(self, socket_path: str = None) -> None:
+        self.socket_path = socket_path or default_socket_path()
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, "sock", None) is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self._local.sock, self._local.rfile = sock, sock.makefile("rb")
+        return self._local.sock, self._local.rfile
+
+    def close(self):
+        if getattr(self._local, "sock", None) is not None:
+            self._local.rfile.close()
+            self._local.sock.close()
+            self._local.sock = None
+
+    def _send(self, request):
+        sock, rfile = self._connection()
+        try:
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            line = rfile.readline()
+            if not line:
+                raise ExileError("Connection to exile agent closed")
+        except (OSError, ExileError):
+            self.close()
+            raise
+        return json.loads(line.decode())
+
+    def _result(self, request, response):
+        if "error" in response:
+            raise _decode_error(response)
+        if request["op"] == "calculate" and not request.get("truncated", True):
+            return base64.b64decode(response["result"])
+        elif request["op"] == "list":
+            return [YKOATHCredential(name=name, oath_type=YKOATH.OATHType[oath_type], algorithm=YKOATH.Algorithm[alg])
+                    for name, oath_type, alg in response["result"]]
+        return response["result"]
+
+    @staticmethod
+    def calculate_request(credential_name: str, challenge, want_truncated_response=True):
+        chal_bytes = challenge if isinstance(challenge, bytes) else challenge.to_bytes(8, byteorder="big")
+        return dict(op="calculate", name=credential_name, challenge=base64.b64encode(chal_bytes).decode(),
+                    truncated=want_truncated_response)
+
+    def calculate(self, credential_name: str, challenge, want_truncated_response=True):
+        request = self.calculate_request(credential_name, challenge, want_truncated_response)
+        return self._result(request, self._send(request))
+
+    def batch(self, requests):
+        """
+        Execute several requests, built with ``calculate_request()``, in one round trip and one card transaction.
+        Returns a list with a result or an exception for each request.
+        """
+        requests = list(requests)
+        responses = self._send(requests)
+        results = []
+        for request, response in zip(requests, responses):
+            try:
+                results.append(self._result(request, response))
+            except ExileError as e:
+                results.append(e)
+        return results
+
+    def __iter__(self):
+        request = dict(op="list")
+        return iter(self._result(request, self._send(request)))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog="python -m exile.agent", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--socket", default=default_socket_path(), help="Path of the Unix socket to listen on")
+    parser.add_argument("--pool", action="store_true", help="Use all attached YubiKeys instead of the first one")
+    parser.add_argument("--password", action="store_true",
+                        help="Prompt for the password of a password-protected device")
+    parsed_args = parser.parse_args(args)
+    password = getpass.getpass("YubiKey OATH password: ") if parsed_args.password else None
+    if parsed_args.pool:
+        from .ykoath.pool import YKOATHPool
+        device = YKOATHPool(password=password)  # type: typing.Any
+    else:
+        device = YKOATH(password=password, persistent=True)
+    server = SigningAgent(device, socket_path=parsed_args.socket)
+    print("EXILE_AGENT_SOCK={}; export EXILE_AGENT_SOCK;".format(server.socket_path))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,365 @@
+import asyncio, threading, hashlib, hmac, logging, typing
+from collections import deque
+from contextlib import contextmanager
 import botocore.auth
 from botocore.compat import encodebytes
-from . import YKOATH
+from .exceptions import ExileError
+from .ykoath.broker import broker
+from .util import ExpiringCache, zeroize
+
+logger = logging.getLogger(__name__)
+
+_device = None
+_local = threading.local()
+_hmac_v1_batch_window = None
+_hmac_v1_scheduler = None
+_hmac_v1_scheduler_lock = threading.Lock()
+
+def get_device():
+    """
+    Return the device that signers use: the one passed to ``install()``, or the shared session for the first YubiKey.
+    """
+    return _device if _device is not None else broker.get()
+
+def _get_hmac_v1_device(auth=None):
+    global _hmac_v1_scheduler
+    if getattr(auth, "exile_device", None) is not None:
+        return auth.exile_device
+    if _hmac_v1_batch_window is None:
+        return get_device()
+    with _hmac_v1_scheduler_lock:
+        if _hmac_v1_scheduler is None:
+            from .ykoath.scheduler import YKOATHScheduler
+            _hmac_v1_scheduler = YKOATHScheduler(get_device(), batch_window=_hmac_v1_batch_window)
+        return _hmac_v1_scheduler
+
+class SigningKeyCache(ExpiringCache):
+    """
+    Caches SigV4 signing keys derived on the YubiKey, keyed by (access key, date, region, service). A cached key is
+    valid for the whole UTC day it was derived for, so ``ttl`` only bounds how long it stays in memory.
+    """
+    def purge(self, access_key=None):
+        ExpiringCache.purge(self, None if access_key is None else lambda key: key[0] == access_key)
 
 class YKSigV4Auth(botocore.auth.SigV4Auth):
-    def signature(self, string_to_sign, request):
-        if not hasattr(self, "_ykoath"):
-            self._ykoath = YKOATH()
+    exile_credential_type = "SigV4"
+    signing_key_cache = None  # type: typing.Optional[SigningKeyCache]
+
+    def signing_key(self, request):
+        datestamp = request.context["timestamp"][0:8]
+        cache_key = (self.credentials.access_key, datestamp, self._region_name, self._service_name)
+        cache = getattr(_local, "signing_key_cache", None)
+        if cache is None:
+            cache = getattr(self, "exile_signing_key_cache", None)
+        if cache is None:
+            cache = YKSigV4Auth.signing_key_cache
+        if cache is not None:
+            k_signing = cache.get(cache_key)
+            if k_signing is not None:
+                return k_signing
         key_name = "exile-{}-SigV4".format(self.credentials.access_key)
-        k_date = self._ykoath.calculate(key_name,
-                                        request.context["timestamp"][0:8].encode(),
-                                        want_truncated_response=False)
+        device = getattr(self, "exile_device", None)
+        if device is None:
+            device = get_device()
+        k_date = device.calculate(key_name, datestamp.encode(), want_truncated_response=False)
         k_region = self._sign(k_date, self._region_name)
         k_service = self._sign(k_region, self._service_name)
         k_signing = self._sign(k_service, "aws4_request")
-        return self._sign(k_signing, string_to_sign, hex=True)
+        if cache is not None:
+            cache.set(cache_key, bytearray(k_signing))
+        return k_signing
+
+    def signature(self, string_to_sign, request):
+        # Called unbound because install() grafts this method onto botocore.auth.SigV4Auth
+        return self._sign(YKSigV4Auth.signing_key(self, request), string_to_sign, hex=True)
+
+class AsyncYKSigV4Auth(YKSigV4Auth):
+    """
+    A SigV4 signer for asyncio code, such as aiobotocore-style request signers that await ``add_auth()``. Signing runs
+    on ``executor`` so that device I/O, including waiting for a touch, does not block the event loop.
+    """
+    def __init__(self, *args, executor=None, **kwargs):
+        YKSigV4Auth.__init__(self, *args, **kwargs)
+        self.executor = executor
+
+    async def add_auth(self, request):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, YKSigV4Auth.add_auth, self, request)
 
 class YKHmacV1Auth(botocore.auth.HmacV1Auth):
+    exile_credential_type = "HmacV1"
+
     def sign_string(self, string_to_sign):
-        if not hasattr(self, "_ykoath"):
-            self._ykoath = YKOATH()
         key_name = "exile-{}-HmacV1".format(self.credentials.access_key)
-        digest = self._ykoath.calculate(key_name, string_to_sign.encode(), want_truncated_response=False)
+        digest = _get_hmac_v1_device(self).calculate(key_name, string_to_sign.encode(), want_truncated_response=False)
         return encodebytes(digest).strip().decode("utf-8")
 
-def install():
+@contextmanager
+def _signing_key_cache_override(cache):
+    previous = getattr(_local, "signing_key_cache", None)
+    _local.signing_key_cache = cache
+    try:
+        yield
+    finally:
+        _local.signing_key_cache = previous
+
+def generate_presigned_urls(client, requests, expires_in: int = 3600, executor=None, max_in_flight: int = 256):
+    """
+    Generate presigned URLs for an iterable of (client method, params) pairs, like ``client.generate_presigned_url()``,
+    deriving the SigV4 signing key on the device once per date instead of once per URL. The signers must be installed
+    with ``install()``.
+
+    Returns an iterator of URLs in the order of ``requests``, which is consumed lazily. If ``executor`` is given, URLs
+    are signed in it with at most ``max_in_flight`` of them pending at a time. The signing key is discarded when the
+    iterator is exhausted or closed.
+    """
+    cache = SigningKeyCache(ttl=86400, max_entries=4)
+
+    def presign(request):
+        method, params = request
+        with _signing_key_cache_override(cache):
+            return client.generate_presigned_url(ClientMethod=method, Params=params, ExpiresIn=expires_in)
+
+    pending = deque()  # type: deque
+    try:
+        requests = iter(requests)
+        # Sign the first URL in this thread, so that executor threads find the signing key in the cache
+        for request in requests:
+            yield presign(request)
+            break
+        if executor is None:
+            for request in requests:
+                yield presign(request)
+            return
+        for request in requests:
+            pending.append(executor.submit(presign, request))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        cache.purge()
+
+class YKChunkedPayloadSigner:
+    """
+    Signs an upload body in ``aws-chunked`` encoding (STREAMING-AWS4-HMAC-SHA256-PAYLOAD), where each chunk's signature
+    is chained to the previous one, starting from the seed signature of the request. Chunks are signed locally with the
+    SigV4 signing key, so an upload of any size needs at most one device operation. The key is zeroed when the last
+    chunk has been signed.
+    """
+    algorithm = "AWS4-HMAC-SHA256-PAYLOAD"
+    empty_sha256 = hashlib.sha256(b"").hexdigest()
+    signature_header_length = len(";chunk-signature=") + 64 + 2
+
+    def __init__(self, signing_key: bytes, timestamp: str, scope: str, seed_signature: str,
+                 chunk_size: int = 64 * 1024) -> None:
+        self.signing_key = bytearray(signing_key)
+        self.timestamp = timestamp
+        self.scope = scope
+        self.previous_signature = seed_signature
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def encoded_length(cls, decoded_length: int, chunk_size: int = 64 * 1024) -> int:
+        """
+        Return the length of the encoded body for a payload of ``decoded_length`` bytes.
+        """
+        def framed_length(length):
+            return len("{:x}".format(length)) + cls.signature_header_length + length + 2
+        full_chunks, remainder = divmod(decoded_length, chunk_size)
+        length = full_chunks * framed_length(chunk_size) + framed_length(0)
+        return length + framed_length(remainder) if remainder else length
+
+    def sign_chunk(self, chunk: bytes) -> bytes:
+        string_to_sign = "\n".join((self.algorithm, self.timestamp, self.scope, self.previous_signature,
+                                    self.empty_sha256, hashlib.sha256(chunk).hexdigest()))
+        self.previous_signature = hmac.new(self.signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return b"".join(("{:x};chunk-signature={}\r\n".format(len(chunk), self.previous_signature).encode(), chunk,
+                         b"\r\n"))
+
+    def chunks(self, body) -> typing.Iterator[bytes]:
+        """
+        Yield the encoded body, one signed chunk at a time, including the final empty chunk. ``body`` can be a file-like
+        object or an iterable of bytes-like objects; it is read lazily and split into chunks of ``chunk_size`` bytes.
+        """
+        try:
+            for chunk in _rechunk(body, self.chunk_size):
+                yield self.sign_chunk(chunk)
+            yield self.sign_chunk(b"")
+        finally:
+            zeroize(self.signing_key)
+
+def _rechunk(body, chunk_size):
+    pieces = iter(lambda: body.read(chunk_size), b"") if hasattr(body, "read") else body
+    buf = bytearray()
+    for piece in pieces:
+        buf += piece
+        while len(buf) >= chunk_size:
+            yield bytes(buf[:chunk_size])
+            del buf[:chunk_size]
+    if buf:
+        yield bytes(buf)
+
+class _ChunkedBodyReader:
+    # A file-like view of the signed chunks with a known length, so that the HTTP client streams it with a
+    # Content-Length instead of falling back to Transfer-Encoding: chunked
+    def __init__(self, chunks, length):
+        self._chunks = chunks
+        self._length = length
+        self._buf = b""
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        while size is None or size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size is None or size < 0:
+            size = len(self._buf)
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+class YKS3StreamingSigV4Auth(botocore.auth.S3SigV4Auth):
+    def payload(self, request):
+        return "STREAMING-AWS4-HMAC-SHA256-PAYLOAD"
+
+def sign_streaming_upload(request, credentials, region_name: str, body, content_length: int,
+                          chunk_size: int = 64 * 1024, service_name: str = "s3"):
+    """
+    Sign ``request``, a botocore ``AWSRequest`` for an S3 PutObject or UploadPart, as a streaming upload of
+    ``content_length`` bytes from ``body`` (a file-like object or an iterable of bytes-like objects), and set its body
+    to a stream of signed chunks. The signers must be installed with ``install()``.
+
+    The request signature and the chunk signatures share one signing key derivation on the device; with a signing key
+    cache, concurrent part uploads of the same day need none. The body can only be sent once, so the request can not
+    be retried.
+    """
+    request.headers["Content-Encoding"] = "aws-chunked"
+    request.headers["X-Amz-Decoded-Content-Length"] = str(content_length)
+    encoded_length = YKChunkedPayloadSigner.encoded_length(content_length, chunk_size)
+    request.headers["Content-Length"] = str(encoded_length)
+    auth = YKS3StreamingSigV4Auth(credentials, service_name, region_name)
+    cache = SigningKeyCache(ttl=3600, max_entries=1)
+    with _signing_key_cache_override(cache):
+        auth.add_auth(request)
+        signing_key = YKSigV4Auth.signing_key(auth, request)
+    cache.purge()
+    seed_signature = request.headers["Authorization"].rsplit("Signature=", 1)[1]
+    signer = YKChunkedPayloadSigner(signing_key, timestamp=request.context["timestamp"],
+                                    scope=auth.credential_scope(request), seed_signature=seed_signature,
+                                    chunk_size=chunk_size)
+    request.data = _ChunkedBodyReader(signer.chunks(body), encoded_length)
+    return request
+
+def install(signing_key_cache: SigningKeyCache = None, device=None, hmac_v1_batch_window: float = None):
+    """
+    Replace the botocore SigV4 and HmacV1 signers with YubiKey-backed ones. If ``signing_key_cache`` is given, SigV4
+    signing keys derived on the YubiKey are kept in it, so the device is only used once per day per region and service.
+    If ``device`` is given (for example, a ``YKOATHPool``), it is used instead of the first YubiKey found.
+
+    If ``hmac_v1_batch_window`` is given, HmacV1 signing requests from all threads are collected for up to that many
+    seconds and executed back to back in one card transaction.
+    """
+    global _device, _hmac_v1_batch_window, _hmac_v1_scheduler
+    with _hmac_v1_scheduler_lock:
+        if _hmac_v1_scheduler is not None:
+            _hmac_v1_scheduler.close()
+        _device, _hmac_v1_batch_window, _hmac_v1_scheduler = device, hmac_v1_batch_window, None
+    YKSigV4Auth.signing_key_cache = signing_key_cache
     botocore.auth.SigV4Auth.signature = YKSigV4Auth.signature
     botocore.auth.HmacV1Auth.sign_string = YKHmacV1Auth.sign_string
+
+_yk_auth_classes = {}  # type: typing.Dict[type, typing.Optional[type]]
+
+def _get_yk_auth_class(auth_class):
+    # Subclass the YK signer as well as the botocore signer, so that service-specific behavior (like S3's payload
+    # signing) is kept, and isinstance() checks against the YK signers hold
+    if auth_class not in _yk_auth_classes:
+        if issubclass(auth_class, botocore.auth.SigV4Auth):
+            yk_auth_class = YKSigV4Auth  # type: typing.Optional[type]
+        elif issubclass(auth_class, botocore.auth.HmacV1Auth):
+            yk_auth_class = YKHmacV1Auth
+        else:
+            yk_auth_class = None
+        if yk_auth_class is None or auth_class in yk_auth_class.__bases__:
+            _yk_auth_classes[auth_class] = yk_auth_class
+        else:
+            _yk_auth_classes[auth_class] = type("YK" + auth_class.__name__, (yk_auth_class, auth_class), {})
+    return _yk_auth_classes[auth_class]
+
+class SessionSigners:
+    """
+    YubiKey-backed signing for the clients of one botocore session; see ``register()``.
+    """
+    def __init__(self, device=None, access_keys: typing.Iterable[str] = None,
+                 signing_key_cache: SigningKeyCache = None) -> None:
+        self.device = device
+        self.access_keys = None if access_keys is None else frozenset(access_keys)
+        self.signing_key_cache = signing_key_cache
+        self._provisioned = {}  # type: typing.Dict[str, typing.Set[str]]
+        self._lock = threading.Lock()
+
+    def is_provisioned(self, access_key: str, credential_type: str) -> bool:
+        """
+        Return whether the device holds the ``exile-<access_key>-<credential_type>`` credential. The device is only
+        asked once per access key; if the credentials can not be listed, the request is signed in software and the
+        device is asked again for the next one.
+        """
+        if self.access_keys is not None:
+            return access_key in self.access_keys
+        with self._lock:
+            if access_key not in self._provisioned:
+                try:
+                    device = self.device if self.device is not None else get_device()
+                    names = {credential.name for credential in device}
+                except (ExileError, OSError) as e:
+                    logger.debug("Could not list YubiKey credentials, signing in software: %s", e)
+                    return False
+                self._provisioned[access_key] = {t for t in ("SigV4", "HmacV1")
+                                                 if "exile-{}-{}".format(access_key, t) in names}
+            return credential_type in self._provisioned[access_key]
+
+    def wrap_request_signer(self, request_signer):
+        get_auth_instance = request_signer.get_auth_instance
+
+        def get_yk_auth_instance(*args, **kwargs):
+            auth = get_auth_instance(*args, **kwargs)
+            auth_class = _get_yk_auth_class(type(auth))
+            credentials = getattr(auth, "credentials", None)
+            if auth_class is not None and credentials is not None and \
+                    self.is_provisioned(credentials.access_key, auth_class.exile_credential_type):
+                auth.__class__ = auth_class
+                auth.exile_device = self.device
+                auth.exile_signing_key_cache = self.signing_key_cache
+            return auth
+        request_signer.get_auth_instance = get_yk_auth_instance
+
+    def _on_creating_client_class(self, class_attributes, base_classes, **kwargs):
+        session_signers = self
+
+        class ExileClientMixin:
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                session_signers.wrap_request_signer(self._request_signer)
+        base_classes.insert(0, ExileClientMixin)
+
+def register(session, device=None, access_keys: typing.Iterable[str] = None,
+             signing_key_cache: SigningKeyCache = None) -> SessionSigners:
+    """
+    Sign requests from clients created by ``session`` (a boto3 or botocore session) after this call with the YubiKey,
+    for access keys whose ``exile-<access key>-SigV4`` or ``exile-<access key>-HmacV1`` credential is on the device.
+    Requests for other access keys are signed in software without using the device. Unlike ``install()``, this does
+    not change signing for other sessions.
+
+    If ``access_keys`` is given, only those access keys are signed with the YubiKey, and the device is not asked which
+    credentials it holds. ``device`` and ``signing_key_cache`` are as for ``install()``.
+    """
+    session_signers = SessionSigners(device=device, access_keys=access_keys, signing_key_cache=signing_key_cache)
+    botocore_session = getattr(session, "_session", session)
+    botocore_session.register("creating-client-class", session_signers._on_creating_client_class)
+    return session_signers
@@ -0,0 +1,156 @@
+"""
+Instrumentation hooks for PC/SC calls and YKOATH instructions::
+
+    from exile import instrumentation
+    histogram = instrumentation.register(instrumentation.Histogram())
+    ...
+    print(histogram.prometheus())
+
+A hook is an object with ``start(event)`` and ``end(event)`` methods, called around every PC/SC call (events of kind
+``pcsc``, named after the SCard* function) and every YKOATH instruction (events of kind ``ykoath``, named after the
+instruction, including its SEND_REMAINING continuations). When no hooks are registered, the instrumented code only
+checks whether the hook list is empty.
+"""
+import time, threading, typing
+from collections import OrderedDict
+
+hooks = []  # type: typing.List[Hook]
+_lock = threading.Lock()
+
+class Event:
+    __slots__ = ("kind", "name", "bytes_sent", "bytes_received", "continuations", "status", "error", "started_at",
+                 "elapsed")
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.continuations = 0
+        self.status = None  # type: typing.Optional[str]
+        self.error = None  # type: typing.Optional[Exception]
+        self.elapsed = None  # type: typing.Optional[float]
+        self.started_at = time.perf_counter()
+
+class Hook:
+    def start(self, event: Event):
+        pass
+
+    def end(self, event: Event):
+        pass
+
+def register(hook: Hook) -> Hook:
+    global hooks
+    with _lock:
+        # Replace the list instead of appending to it, so that calls in progress see a consistent set of hooks
+        hooks = hooks + [hook]
+    return hook
+
+def unregister(hook: Hook):
+    global hooks
+    with _lock:
+        hooks = [h for h in hooks if h is not hook]
+
+def start(kind: str, name: str) -> Event:
+    event = Event(kind, name)
+    for hook in hooks:
+        hook.start(event)
+    return event
+
+def end(event: Event, status: str = None, bytes_sent: int = 0, bytes_received: int = 0, continuations: int = 0,
+        error: Exception = None):
+    event.elapsed = time.perf_counter() - event.started_at
+    event.status, event.error = status, error
+    event.bytes_sent, event.bytes_received, event.continuations = bytes_sent, bytes_received, continuations
+    for hook in hooks:
+        hook.end(event)
+
+class _Series:
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.continuations = 0
+        self.statuses = OrderedDict()  # type: OrderedDict
+
+class Histogram(Hook):
+    """
+    Aggregates the elapsed time, bytes transferred, SEND_REMAINING continuations and status words of events by kind
+    and name. ``buckets`` are the upper bounds, in seconds, of the latency histogram buckets.
+    """
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets: typing.Sequence[float] = default_buckets) -> None:
+        self.buckets = tuple(sorted(buckets))
+        self._series = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+
+    def end(self, event: Event):
+        elapsed = event.elapsed or 0.0
+        with self._lock:
+            series = self._series.get((event.kind, event.name))
+            if series is None:
+                series = self._series[(event.kind, event.name)] = _Series(self.buckets)
+            for i, bound in enumerate(self.buckets):
+                if elapsed <= bound:
+                    break
+            else:
+                i = len(self.buckets)
+            series.bucket_counts[i] += 1
+            series.count += 1
+            series.sum += elapsed
+            series.bytes_sent += event.bytes_sent
+            series.bytes_received += event.bytes_received
+            series.continuations += event.continuations
+            status = event.status if event.error is None else type(event.error).__name__
+            series.statuses[status] = series.statuses.get(status, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def as_dict(self):
+        """
+        Return the aggregated metrics as ``{kind: {name: metrics}}``, with cumulative bucket counts keyed by upper
+        bound.
+        """
+        res = OrderedDict()  # type: OrderedDict
+        with self._lock:
+            for (kind, name), series in self._series.items():
+                cumulative, buckets = 0, OrderedDict()  # type: typing.Tuple[int, OrderedDict]
+                for bound, count in zip(self.buckets + (float("inf"),), series.bucket_counts):
+                    cumulative += count
+                    buckets[bound] = cumulative
+                res.setdefault(kind, OrderedDict())[name] = dict(count=series.count, sum=series.sum, buckets=buckets,
+                                                                 bytes_sent=series.bytes_sent,
+                                                                 bytes_received=series.bytes_received,
+                                                                 continuations=series.continuations,
+                                                                 statuses=dict(series.statuses))
+        return res
+
+    def prometheus(self, prefix: str = "exile") -> str:
+        """
+        Return the aggregated metrics in the Prometheus text exposition format.
+        """
+        lines = ["# TYPE {}_duration_seconds histogram".format(prefix)]
+        metric_names = ("bytes_sent", "bytes_received", "continuations", "status")
+        counters = OrderedDict((metric, []) for metric in metric_names)  # type: OrderedDict
+        for kind, names in self.as_dict().items():
+            for name, metrics in names.items():
+                labels = 'kind="{}",name="{}"'.format(kind, name)
+                for bound, count in metrics["buckets"].items():
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append('{}_duration_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, le, count))
+                lines.append("{}_duration_seconds_sum{{{}}} {!r}".format(prefix, labels, metrics["sum"]))
+                lines.append("{}_duration_seconds_count{{{}}} {}".format(prefix, labels, metrics["count"]))
+                for metric in ("bytes_sent", "bytes_received", "continuations"):
+                    counters[metric].append("{}_{}_total{{{}}} {}".format(prefix, metric, labels, metrics[metric]))
+                for status, count in metrics["statuses"].items():
+                    sample = '{}_status_total{{{},status="{}"}} {}'.format(prefix, labels, status, count)
+                    counters["status"].append(sample)
+        for metric, samples in counters.items():
+            lines.append("# TYPE {}_{}_total counter".format(prefix, metric))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
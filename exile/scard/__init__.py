@@ -1,9 +1,11 @@
-import platform, logging
+import platform, logging, threading, typing
+from contextlib import contextmanager
 from enum import Enum
 from binascii import b2a_hex, a2b_hex
-from ctypes import (cdll, c_void_p, POINTER, c_ulong, c_char, c_uint32, byref, create_string_buffer, c_wchar,
-                    cast, c_char_p)
+from ctypes import (cdll, c_void_p, POINTER, c_ulong, c_char, c_uint32, c_int32, c_long, c_size_t, byref,
+                    create_string_buffer, c_wchar, cast, c_char_p)
 from ..exceptions import SCardError
+from .. import instrumentation
 from .const import SCardConstants
 
 logger = logging.getLogger(__name__)
@@ -14,32 +16,105 @@ def i2b(i):
 def b2i(data):
     return int(b2a_hex(data), 16)
 
-class SCARDCONTEXT(c_uint32):
+system = platform.system()
+
+if typing.TYPE_CHECKING:
+    # The type checker needs plain aliases; the sizes themselves depend on the platform
+    DWORD = c_ulong
+    LONG_PTR = c_long
+elif system == "Windows":
+    DWORD, LONG_PTR = c_ulong, c_size_t
+elif system == "Darwin":
+    DWORD, LONG_PTR = c_uint32, c_int32
+else:
+    DWORD, LONG_PTR = c_ulong, c_long
+
+class SCARDCONTEXT(LONG_PTR):
     pass
 
-class SCARDHANDLE(c_uint32):
+class SCARDHANDLE(LONG_PTR):
     pass
 
+class PCSCLibrary:
+    """
+    The platform PC/SC library, shared by all SCard objects. It is loaded on first use, and ctypes prototypes are
+    declared once for each SCard* function.
+    """
+    names = {"Darwin": "PCSC.framework/PCSC", "Linux": "libpcsclite.so", "Windows": "winscard.dll"}
+    prototypes = {
+        "SCardEstablishContext": (DWORD, c_void_p, c_void_p, POINTER(SCARDCONTEXT)),
+        "SCardReleaseContext": (SCARDCONTEXT,),
+        "SCardIsValidContext": (SCARDCONTEXT,),
+        "SCardSetTimeout": (SCARDCONTEXT, DWORD),
+        "SCardConnect": (SCARDCONTEXT, c_char_p, DWORD, DWORD, POINTER(SCARDHANDLE), POINTER(DWORD)),
+        "SCardReconnect": (SCARDHANDLE, DWORD, DWORD, DWORD, POINTER(DWORD)),
+        "SCardDisconnect": (SCARDHANDLE, DWORD),
+        "SCardBeginTransaction": (SCARDHANDLE,),
+        "SCardEndTransaction": (SCARDHANDLE, DWORD),
+        "SCardStatus": (SCARDHANDLE, c_void_p, c_void_p, c_void_p, c_void_p, c_void_p, c_void_p),
+        "SCardGetStatusChange": (SCARDCONTEXT, DWORD, c_void_p, DWORD),
+        "SCardControl": (SCARDHANDLE, DWORD, c_void_p, DWORD, c_void_p, DWORD, c_void_p),
+        "SCardTransmit": (SCARDHANDLE, c_void_p, c_void_p, DWORD, c_void_p, c_void_p, POINTER(DWORD)),
+        "SCardListReaderGroups": (SCARDCONTEXT, c_void_p, POINTER(DWORD)),
+        "SCardListReaders": (SCARDCONTEXT, c_void_p, c_void_p, POINTER(DWORD)),
+        "SCardCancel": (SCARDCONTEXT,),
+        "SCardGetAttrib": (SCARDHANDLE, DWORD, c_void_p, c_void_p),
+        "SCardSetAttrib": (SCARDHANDLE, DWORD, c_void_p, DWORD),
+    }
+
+    def __init__(self) -> None:
+        self._lib = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self._lib is None:
+            with self._lock:
+                if self._lib is None:
+                    self._lib = self.load()
+        return self._lib
+
+    def load(self):
+        lib = cdll.LoadLibrary(self.names[system])
+        for name, argtypes in self.prototypes.items():
+            try:
+                function = getattr(lib, name)
+            except AttributeError:
+                try:
+                    # winscard.dll only exports the ANSI and wide variants of functions that take strings
+                    function = getattr(lib, name + "A")
+                    setattr(lib, name, function)
+                except AttributeError:
+                    continue
+            function.argtypes = argtypes
+            # Status codes are LONG, but compared as unsigned 32-bit values
+            function.restype = c_uint32
+        return lib
+
 class SCard(SCardConstants):
     """
     See https://docs.microsoft.com/en-us/windows/desktop/api/winscard/
     """
-    def __init__(self):
-        if platform.system() == "Darwin":
-            lib_name = "PCSC.framework/PCSC"
-        elif platform.system() == "Linux":
-            lib_name = "libpcsclite.so"
-        elif platform.system() == "Windows":
-            lib_name = "winscard.dll"
-        self.pcsc = cdll.LoadLibrary(lib_name)
-
-    def __call__(self, method, *args):
-        logger.debug(method + str(args))
-        status = getattr(self.pcsc, method)(*args)
+    pcsc = PCSCLibrary()
+
+    def _call(self, function, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s%s", function.__name__, args)
+        if instrumentation.hooks:
+            event = instrumentation.start("pcsc", function.__name__)
+            status = function(*args)
+            instrumentation.end(event, status=self._status_name(status))
+        else:
+            status = function(*args)
         if status != self.SCardStatus.S_SUCCESS.value:
             raise SCardError(self.SCardStatus(status))
         return status
 
+    def _status_name(self, status):
+        try:
+            return self.SCardStatus(status).name
+        except ValueError:
+            return "0x{:08x}".format(status)
+
     def EstablishContext(self, dwScope: SCardConstants.Scope,
                          pvReserved1: c_void_p,
                          pvReserved2: c_void_p,
@@ -48,7 +123,7 @@ class SCard(SCardConstants):
         The SCardEstablishContext function establishes the resource manager context (the scope) within which database
         operations are performed.
         """
-        return self("SCardEstablishContext", dwScope, pvReserved1, pvReserved2, phContext)
+        return self._call(self.pcsc.SCardEstablishContext, dwScope, pvReserved1, pvReserved2, phContext)
 
     def ReleaseContext(self, hContext: SCARDCONTEXT) -> SCardConstants.SCardStatus:
         """
@@ -56,16 +131,16 @@ class SCard(SCardConstants):
         under that context, including SCARDHANDLE objects and memory allocated using the SCARD_AUTOALLOCATE length
         designator.
         """
-        return self("SCardReleaseContext", hContext)
+        return self._call(self.pcsc.SCardReleaseContext, hContext)
 
     def IsValidContext(self, hContext: SCARDCONTEXT) -> SCardConstants.SCardStatus:
         """
         The SCardIsValidContext function determines whether a smart card context handle is valid.
         """
-        return self("SCardIsValidContext", hContext)
+        return self._call(self.pcsc.SCardIsValidContext, hContext)
 
     def SetTimeout(self, hContext: SCARDCONTEXT, dwTimeout: int) -> SCardConstants.SCardStatus:
-        return self("SCardSetTimeout", hContext, dwTimeout)
+        return self._call(self.pcsc.SCardSetTimeout, hContext, dwTimeout)
 
     def Connect(self, hContext: SCARDCONTEXT,
                 szReader: c_char_p,
@@ -78,7 +153,8 @@ class SCard(SCardConstants):
         calling application and a smart card contained by a specific reader. If no card exists in the specified reader,
         an error is returned.
         """
-        return self("SCardConnect", hContext, szReader, dwShareMode, dwPreferredProtocols, phCard, pdwActiveProtocol)
+        return self._call(self.pcsc.SCardConnect, hContext, szReader, dwShareMode, dwPreferredProtocols, phCard,
+                          pdwActiveProtocol)
 
     def Reconnect(self, hCard: SCARDHANDLE,
                   dwShareMode: SCardConstants.ShareMode,
@@ -90,14 +166,15 @@ class SCard(SCardConstants):
         card. This function moves a card handle from direct access to general access, or acknowledges and clears an
         error condition that is preventing further access to the card.
         """
-        return self("SCardConnect", hCard, dwShareMode, dwPreferredProtocols, dwInitialization, pdwActiveProtocol)
+        return self._call(self.pcsc.SCardReconnect, hCard, dwShareMode, dwPreferredProtocols, dwInitialization,
+                          pdwActiveProtocol)
 
     def Disconnect(self, hCard: SCARDHANDLE, dwDisposition: SCardConstants.Disposition) -> SCardConstants.SCardStatus:
         """
         The SCardDisconnect function terminates a connection previously opened between the calling application and a
         smart card in the target reader.
         """
-        return self("SCardDisconnect", hCard, dwDisposition)
+        return self._call(self.pcsc.SCardDisconnect, hCard, dwDisposition)
 
     def BeginTransaction(self, hCard: SCARDHANDLE) -> SCardConstants.SCardStatus:
         """
@@ -106,7 +183,7 @@ class SCard(SCardConstants):
         The function waits for the completion of all other transactions before it begins. After the transaction starts,
         all other applications are blocked from accessing the smart card while the transaction is in progress.
         """
-        return self("SCardBeginTransaction", hCard)
+        return self._call(self.pcsc.SCardBeginTransaction, hCard)
 
     def EndTransaction(self, hCard: SCARDHANDLE,
                        dwDisposition: SCardConstants.Disposition) -> SCardConstants.SCardStatus:
@@ -114,7 +191,7 @@ class SCard(SCardConstants):
         The SCardEndTransaction function completes a previously declared transaction, allowing other applications to
         resume interactions with the card.
         """
-        return self("SCardEndTransaction", hCard, dwDisposition)
+        return self._call(self.pcsc.SCardEndTransaction, hCard, dwDisposition)
 
     def CancelTransaction(self, hCard: SCARDHANDLE) -> SCardConstants.SCardStatus:
         raise NotImplementedError()
@@ -131,13 +208,14 @@ class SCard(SCardConstants):
         after a successful call to SCardConnect and before a successful call to SCardDisconnect. It does not affect the
         state of the reader or reader driver.
         """
-        return self("SCardStatus", hCard, mszReaderNames, pcchReaderLen, pdwState, pdwProtocol, pbAtr, pcbAtrLen)
+        return self._call(self.pcsc.SCardStatus, hCard, mszReaderNames, pcchReaderLen, pdwState, pdwProtocol, pbAtr,
+                          pcbAtrLen)
 
     def GetStatusChange(self, hContext: SCARDCONTEXT,
                         dwTimeout,
                         rgReaderStates: SCardConstants.ReaderState,
                         cReaders) -> SCardConstants.SCardStatus:
-        return self("SCardGetStatusChange", hContext, dwTimeout, rgReaderStates, cReaders)
+        return self._call(self.pcsc.SCardGetStatusChange, hContext, dwTimeout, rgReaderStates, cReaders)
 
     def Control(self, hCard: SCARDHANDLE,
                 dwControlCode,
@@ -151,8 +229,8 @@ class SCard(SCardConstants):
         call to SCardConnect and before a successful call to SCardDisconnect. The effect on the state of the reader
         depends on the control code.
         """
-        return self("SCardControl", hCard, dwControlCode, pbSendBuffer, cbSendLength, pbRecvBuffer, cbRecvLength,
-                    lpBytesReturned)
+        return self._call(self.pcsc.SCardControl, hCard, dwControlCode, pbSendBuffer, cbSendLength, pbRecvBuffer,
+                          cbRecvLength, lpBytesReturned)
 
     def Transmit(self, hCard: SCARDHANDLE,
                  pioSendPci,
@@ -165,11 +243,11 @@ class SCard(SCardConstants):
         The SCardTransmit function sends a service request to the smart card and expects to receive data back from the
         card.
         """
-        return self("SCardTransmit", hCard, pioSendPci, pbSendBuffer, cbSendLength, pioRecvPci, pbRecvBuffer,
-                    pcbRecvLength)
+        return self._call(self.pcsc.SCardTransmit, hCard, pioSendPci, pbSendBuffer, cbSendLength, pioRecvPci,
+                          pbRecvBuffer, pcbRecvLength)
 
     def ListReaderGroups(self, hContext: SCARDCONTEXT, mszGroups, pcchGroups) -> SCardConstants.SCardStatus:
-        return self("SCardListReaderGroups", hContext, mszGroups, pcchGroups)
+        return self._call(self.pcsc.SCardListReaderGroups, hContext, mszGroups, pcchGroups)
 
     def ListReaders(self, hContext: SCARDCONTEXT, mszGroups, mszReaders, pcchReaders) -> SCardConstants.SCardStatus:
         """
@@ -180,7 +258,7 @@ class SCard(SCardConstants):
         Unrecognized group names are ignored. This function only returns readers within the named groups that
         are currently attached to the system and available for use.
         """
-        return self("SCardListReaders", hContext, mszGroups, mszReaders, pcchReaders)
+        return self._call(self.pcsc.SCardListReaders, hContext, mszGroups, mszReaders, pcchReaders)
 
     def Cancel(self, hContext: SCARDCONTEXT) -> SCardConstants.SCardStatus:
         """
@@ -190,14 +268,14 @@ class SCard(SCardConstants):
         user. Any such outstanding action requests will terminate with a status indication that the action was
         canceled. This is especially useful to force outstanding SCardGetStatusChange calls to terminate.
         """
-        return self("SCardCancel", hContext)
+        return self._call(self.pcsc.SCardCancel, hContext)
 
     def GetAttrib(self, hCard: SCARDHANDLE, dwAttrId, pbAttr, pcbAttrLen) -> SCardConstants.SCardStatus:
         """
         The SCardGetAttrib function retrieves the current reader attributes for the given handle. It does not affect the
         state of the reader, driver, or card.
         """
-        return self("SCardGetAttrib", hCard, dwAttrId, pbAttr, pcbAttrLen)
+        return self._call(self.pcsc.SCardGetAttrib, hCard, dwAttrId, pbAttr, pcbAttrLen)
 
     def SetAttrib(self, hCard: SCARDHANDLE, dwAttrId, pbAttr, cbAttrLen) -> SCardConstants.SCardStatus:
         """
@@ -205,63 +283,162 @@ class SCard(SCardConstants):
         of the reader, reader driver, or smart card. Not all attributes are supported by all readers (nor can they be
         set at all times) as many of the attributes are under direct control of the transport protocol.
         """
-        return self("SCardSetAttrib", hCard, dwAttrId, pbAttr, cbAttrLen)
+        return self._call(self.pcsc.SCardSetAttrib, hCard, dwAttrId, pbAttr, cbAttrLen)
 
 
 class SCardManager(SCard):
     def __init__(self):
-        SCard.__init__(self)
         self.ctx = SCARDCONTEXT()
-        self.protocol = c_ulong()
+        self.protocol = DWORD()
         self.EstablishContext(dwScope=self.Scope.SYSTEM, pvReserved1=0, pvReserved2=0, phContext=byref(self.ctx))
 
     def _split_multi_string(self, ms):
         p = cast(ms, POINTER(c_char))
         return p[:len(ms)].split(b"\0")
 
-    def _get_send_pci(self):
-        if self.protocol.value == self.Protocol.T0:
+    def _get_send_pci(self, protocol=None):
+        if protocol is None:
+            protocol = self.protocol
+        if protocol.value == self.Protocol.T0:
             return self.pcsc.g_rgSCardT0Pci
-        elif self.protocol.value == self.Protocol.T1:
+        elif protocol.value == self.Protocol.T1:
             return self.pcsc.g_rgSCardT1Pci
 
-    def __iter__(self):
-        pcch_readers = c_uint32()
-        self.ListReaders(hContext=self.ctx, mszGroups=0, mszReaders=0, pcchReaders=byref(pcch_readers))
+    def list_readers(self, ctx: SCARDCONTEXT = None):
+        """
+        Return the names of the attached readers.
+        """
+        ctx = self.ctx if ctx is None else ctx
+        pcch_readers = DWORD()
+        self.ListReaders(hContext=ctx, mszGroups=0, mszReaders=0, pcchReaders=byref(pcch_readers))
         s = create_string_buffer(b"\0" * pcch_readers.value)
-        self.ListReaders(hContext=self.ctx, mszGroups=0, mszReaders=s, pcchReaders=byref(pcch_readers))
-        for reader in self._split_multi_string(s):
-            if reader:
-                yield SCardReader(name=reader.decode(), manager=self)
+        self.ListReaders(hContext=ctx, mszGroups=0, mszReaders=s, pcchReaders=byref(pcch_readers))
+        return [reader.decode() for reader in self._split_multi_string(s) if reader]
+
+    def __iter__(self):
+        for name in self.list_readers():
+            yield SCardReader(name=name, manager=self)
 
 
 class SCardReader(SCard):
-    def __init__(self, name: str, manager: SCardManager) -> None:
-        SCard.__init__(self)
+    """
+    A smart card reader. By default, a connection to the card is opened on entering the context manager and closed on
+    exit. If ``persistent`` is set, the connection is kept open after the first use until ``disconnect()`` is called.
+    """
+    def __init__(self, name: str, manager: SCardManager, persistent: bool = False) -> None:
         self.name = name
         self.manager = manager
+        self.persistent = persistent
+        self.connected = False
+        self.in_transaction = False
         self.handle = SCARDHANDLE()
+        self.protocol = DWORD()
+        self._send_buf = create_string_buffer(self.MAX_BUFFER_SIZE)
+        self._send_view = memoryview(self._send_buf).cast("B")
+        self._recv_bufs = {}  # type: dict
+        self._recv_len = DWORD()
+        self._recv_len_ref = byref(self._recv_len)
+
+    def connect(self):
+        if not self.connected:
+            self.Connect(hContext=self.manager.ctx,
+                         szReader=c_char_p(self.name.encode()),
+                         dwShareMode=self.ShareMode.SHARED,
+                         dwPreferredProtocols=self.Protocol.ANY,
+                         phCard=byref(self.handle),
+                         pdwActiveProtocol=byref(self.protocol))
+            self.connected = True
+
+    def disconnect(self, disposition=SCardConstants.Disposition.LEAVE_CARD):
+        if self.connected:
+            self.connected = False
+            self.in_transaction = False
+            self.Disconnect(hCard=self.handle, dwDisposition=disposition)
+
+    def reconnect(self):
+        """
+        Acknowledge a reset of the card by another application, or reopen the connection if the card was removed and
+        reinserted.
+        """
+        if not self.connected:
+            return self.connect()
+        try:
+            self.Reconnect(hCard=self.handle,
+                           dwShareMode=self.ShareMode.SHARED,
+                           dwPreferredProtocols=self.Protocol.ANY,
+                           dwInitialization=self.Disposition.LEAVE_CARD,
+                           pdwActiveProtocol=byref(self.protocol))
+        except SCardError:
+            self.connected = False
+            try:
+                self.Disconnect(hCard=self.handle, dwDisposition=self.Disposition.LEAVE_CARD)
+            except SCardError:
+                pass
+            self.connect()
+        if self.in_transaction:
+            self.BeginTransaction(hCard=self.handle)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Block other applications from accessing the card while the context manager is active. The reader must be
+        connected.
+        """
+        self.BeginTransaction(hCard=self.handle)
+        self.in_transaction = True
+        try:
+            yield self
+        finally:
+            if self.in_transaction:
+                self.in_transaction = False
+                try:
+                    self.EndTransaction(hCard=self.handle, dwDisposition=self.Disposition.LEAVE_CARD)
+                except SCardError as e:
+                    # The card was reset or removed, which already ended the transaction
+                    logger.debug("EndTransaction failed: %s", e)
+
+    def cancel(self):
+        """
+        Terminate outstanding actions that are waiting for the card or the user within this reader's context.
+        """
+        self.Cancel(hContext=self.manager.ctx)
 
     def __enter__(self):
-        self.Connect(hContext=self.manager.ctx,
-                     szReader=c_char_p(self.name.encode()),
-                     dwShareMode=self.ShareMode.SHARED,
-                     dwPreferredProtocols=self.Protocol.ANY,
-                     phCard=byref(self.handle),
-                     pdwActiveProtocol=byref(self.manager.protocol))
+        self.connect()
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.Disconnect(hCard=self.handle, dwDisposition=self.Disposition.LEAVE_CARD)
+        if not self.persistent:
+            self.disconnect()
+
+    def _get_recv_buf(self, size):
+        if size not in self._recv_bufs:
+            buf = create_string_buffer(size)
+            self._recv_bufs[size] = (buf, memoryview(buf).cast("B"))
+        return self._recv_bufs[size]
 
-    def send_apdu(self, cla, ins, p1, p2, data):
-        send_buf = create_string_buffer(i2b(cla) + i2b(ins) + i2b(p1) + i2b(p2) + i2b(len(data)) + data)
-        recv_buf = create_string_buffer(b"\0" * self.MAX_BUFFER_SIZE_EXTENDED)
-        recv_len = c_ulong(len(recv_buf))
+    def send_apdu(self, cla, ins, p1, p2, data, extended_response=False):
+        """
+        Transmit a short APDU and return the response, including the status word, as a memoryview. The send and receive
+        buffers belong to the reader and are reused, so the response must be copied before the next APDU is sent.
+        Unless ``extended_response`` is set, the receive buffer is sized for a short APDU response. Raises
+        ``SCardError(E_INVALID_PARAMETER)`` if ``data`` is longer than the 255 bytes a short APDU can carry.
+        """
+        send_view, data_len = self._send_view, len(data)
+        if data_len > 0xff:
+            # Lc is one byte in a short APDU
+            raise SCardError(self.SCardStatus.E_INVALID_PARAMETER)
+        send_view[0], send_view[1], send_view[2], send_view[3], send_view[4] = cla, ins, p1, p2, data_len
+        send_view[5:5 + data_len] = data
+        send_view[5 + data_len] = 0  # Le
+        recv_buf, recv_view = self._get_recv_buf(self.MAX_BUFFER_SIZE_EXTENDED if extended_response
+                                                 else self.MAX_BUFFER_SIZE)
+        self._recv_len.value = len(recv_buf)
         self.Transmit(hCard=self.handle,
-                      pioSendPci=self.manager._get_send_pci(),
-                      pbSendBuffer=send_buf,
-                      cbSendLength=len(send_buf),
+                      pioSendPci=self.manager._get_send_pci(self.protocol),
+                      pbSendBuffer=self._send_buf,
+                      cbSendLength=6 + data_len,
                       pioRecvPci=0,
                       pbRecvBuffer=recv_buf,
-                      pcbRecvLength=byref(recv_len))
-        return recv_buf.raw[:recv_len.value]
+                      pcbRecvLength=self._recv_len_ref)
+        return recv_view[:self._recv_len.value]
@@ -0,0 +1,171 @@
+"""
+A registry of attached smart card readers, kept up to date by a background thread that waits for reader and card
+arrival and removal events with SCardGetStatusChange::
+
+    monitor = ReaderMonitor(timeout=10).start()
+    reader = monitor.wait_for("yubico yubikey")
+
+Set ``YKOATH.reader_monitor`` to a started monitor to look up devices in the registry instead of enumerating readers for
+each new session.
+"""
+import threading, logging, typing
+from ctypes import Structure, c_char_p, c_void_p, c_ubyte, byref
+from ..exceptions import SCardError
+from .const import SCardConstants
+from . import system, DWORD, SCARDCONTEXT, SCard, SCardManager, SCardReader
+
+logger = logging.getLogger(__name__)
+
+class SCARD_READERSTATE(Structure):
+    if system == "Darwin":
+        _pack_ = 1
+    _fields_ = [("szReader", c_char_p),
+                ("pvUserData", c_void_p),
+                ("dwCurrentState", DWORD),
+                ("dwEventState", DWORD),
+                ("cbAtr", DWORD),
+                ("rgbAtr", c_ubyte * (36 if system == "Windows" else SCardConstants.MAX_ATR_SIZE))]
+
+class ReaderMonitor(SCard):
+    """
+    Tracks which readers are attached and have a card present. The background thread blocks in SCardGetStatusChange
+    on its own context, watching each reader and the ``\\\\?PnP?\\Notification`` pseudo-reader, which signals reader
+    arrival and removal. Where the pseudo-reader is not supported, the reader list is polled every ``poll_interval``
+    seconds instead. ``timeout`` is the default number of seconds ``wait_for()`` waits for a device to appear.
+    """
+    pnp_notification = b"\\\\?PnP?\\Notification"
+    INFINITE = 0xffffffff
+    service_errors = {SCardConstants.SCardStatus.E_NO_SERVICE, SCardConstants.SCardStatus.E_SERVICE_STOPPED,
+                      SCardConstants.SCardStatus.E_INVALID_HANDLE}
+
+    def __init__(self, timeout: float = 0, poll_interval: float = 1) -> None:
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # Readers are handed out with a separate context, so cancelling an operation on a reader does not interrupt
+        # the monitor's wait, and stopping the monitor does not interrupt operations on readers
+        self.manager = SCardManager()
+        self.ctx = SCARDCONTEXT()
+        self._establish_context()
+        self.present = set()  # type: typing.Set[str]
+        self._states = {}  # type: typing.Dict[bytes, int]
+        self._pnp_supported = True
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None  # type: typing.Optional[threading.Thread]
+
+    def start(self):
+        """
+        Scan the readers, then start watching for changes in a daemon thread. Returns the monitor.
+        """
+        if self._thread is None:
+            self._stopped.clear()
+            try:
+                self._update(timeout=0)
+            except SCardError as e:
+                if e.args[0] != self.SCardStatus.E_TIMEOUT:
+                    raise
+            self._thread = threading.Thread(target=self._run, name="exile-reader-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            try:
+                self.Cancel(hContext=self.ctx)
+            except SCardError as e:
+                logger.debug("SCardCancel failed: %s", e)
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self.ReleaseContext(hContext=self.ctx)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._update(timeout=self.INFINITE if self._pnp_supported else int(self.poll_interval * 1000))
+            except SCardError as e:
+                status = e.args[0]
+                if status in {self.SCardStatus.E_TIMEOUT, self.SCardStatus.E_CANCELLED}:
+                    continue
+                logger.debug("SCardGetStatusChange failed: %s", e)
+                if self._stopped.wait(self.poll_interval):
+                    break
+                if status in self.service_errors:
+                    self._reestablish_context()
+
+    def _reestablish_context(self):
+        try:
+            self.ReleaseContext(hContext=self.ctx)
+        except SCardError:
+            pass
+        try:
+            self._establish_context()
+        except SCardError as e:
+            logger.debug("SCardEstablishContext failed: %s", e)
+        self._states.clear()
+
+    def _establish_context(self):
+        self.EstablishContext(dwScope=self.Scope.SYSTEM, pvReserved1=0, pvReserved2=0, phContext=byref(self.ctx))
+
+    def _list_readers(self):
+        try:
+            return [name.encode() for name in self.manager.list_readers(ctx=self.ctx)]
+        except SCardError as e:
+            if e.args[0] != self.SCardStatus.E_NO_READERS_AVAILABLE:
+                raise
+            return []
+
+    def _update(self, timeout):
+        names = self._list_readers() + [self.pnp_notification]
+        states = (SCARD_READERSTATE * len(names))()
+        for state, name in zip(states, names):
+            state.szReader = name
+            state.dwCurrentState = self._states.get(name, self.ReaderState.UNAWARE)
+        self.GetStatusChange(hContext=self.ctx, dwTimeout=timeout, rgReaderStates=states, cReaders=len(names))
+        self._states = {name: state.dwEventState & ~self.ReaderState.CHANGED for state, name in zip(states, names)}
+        if states[-1].dwEventState & self.ReaderState.UNKNOWN:
+            self._pnp_supported = False
+        present = {name.decode() for state, name in zip(states[:-1], names)
+                   if state.dwEventState & self.ReaderState.PRESENT and not state.dwEventState & self.ReaderState.MUTE}
+        with self._condition:
+            if present != self.present:
+                logger.debug("Readers with a card present: %s", present)
+                self.present = present
+                self._condition.notify_all()
+
+    def _find(self, prefix):
+        for name in sorted(self.present):
+            if name.lower().startswith(prefix):
+                return name
+        return None
+
+    def find(self, prefix: str) -> typing.Optional[SCardReader]:
+        """
+        Return a reader whose name starts with ``prefix`` and that has a card present, or None.
+        """
+        with self._condition:
+            name = self._find(prefix)
+        return None if name is None else SCardReader(name=name, manager=self.manager)
+
+    def find_all(self, prefix: str) -> typing.List[SCardReader]:
+        with self._condition:
+            names = sorted(name for name in self.present if name.lower().startswith(prefix))
+        return [SCardReader(name=name, manager=self.manager) for name in names]
+
+    def wait_for(self, prefix: str, timeout: float = None) -> typing.Optional[SCardReader]:
+        """
+        Like ``find()``, but wait up to ``timeout`` seconds (by default, the monitor's ``timeout``) for a matching
+        reader with a card present to appear.
+        """
+        with self._condition:
+            name = self._condition.wait_for(lambda: self._find(prefix), self.timeout if timeout is None else timeout)
+        return None if name is None else SCardReader(name=name, manager=self.manager)
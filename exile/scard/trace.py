@@ -0,0 +1,172 @@
+"""
+Record APDU exchanges with a card to a trace file, and replay them without the card::
+
+    ykoath = YKOATH(device=RecordingTransport(reader, "yubikey.trace"))
+    ...
+    ykoath = YKOATH(device=ReplayTransport("yubikey.trace", speed=0))
+
+A trace file starts with a header (the magic bytes ``EXTR``, a format version and the reader name), followed by one
+record per exchange: when it started and how long it took, the command header and data, and either the response,
+including the status word, or the PC/SC status of the error that was raised.
+"""
+import time, struct, threading, typing
+from collections import namedtuple
+from contextlib import contextmanager
+from ..exceptions import ExileError, SCardError
+from .const import SCardConstants
+
+TraceRecord = namedtuple("TraceRecord", ("started_at", "duration", "cla", "ins", "p1", "p2", "data", "response",
+                                         "error"))
+
+magic = b"EXTR"
+version = 1
+_header = struct.Struct("<4sBH")
+_record = struct.Struct("<ddBBBBHII")
+
+def write_header(fh, reader_name: str):
+    name = reader_name.encode()
+    fh.write(_header.pack(magic, version, len(name)) + name)
+
+def write_record(fh, record: TraceRecord):
+    fh.write(b"".join((_record.pack(record.started_at, record.duration, record.cla, record.ins, record.p1, record.p2,
+                                    len(record.data), len(record.response), record.error or 0),
+                       record.data, record.response)))
+
+def read_trace(fh) -> typing.Tuple[str, typing.Iterator[TraceRecord]]:
+    """
+    Read a trace from a binary file object. Returns the reader name and an iterator of records, which are read lazily.
+    """
+    header = fh.read(_header.size)
+    if len(header) < _header.size or header[:4] != magic:
+        raise ExileError("Not an APDU trace file")
+    _, trace_version, name_length = _header.unpack(header)
+    if trace_version != version:
+        raise ExileError("Unsupported APDU trace version {}".format(trace_version))
+    reader_name = fh.read(name_length).decode()
+
+    def records():
+        while True:
+            fields = fh.read(_record.size)
+            if not fields:
+                return
+            if len(fields) < _record.size:
+                raise ExileError("Truncated APDU trace")
+            started_at, duration, cla, ins, p1, p2, data_length, response_length, error = _record.unpack(fields)
+            data, response = fh.read(data_length), fh.read(response_length)
+            if len(data) + len(response) < data_length + response_length:
+                raise ExileError("Truncated APDU trace")
+            yield TraceRecord(started_at, duration, cla, ins, p1, p2, data, response, error or None)
+    return reader_name, records()
+
+class RecordingTransport:
+    """
+    Wraps an ``SCardReader`` (or anything with the same interface, like ``YKOATHEmulator``) and records each APDU
+    exchange to ``path``. Call ``close()`` to flush the trace.
+    """
+    def __init__(self, device, path: str) -> None:
+        self.device = device
+        self._fh = open(path, "wb")
+        self._lock = threading.Lock()
+        self._started_at = time.perf_counter()
+        write_header(self._fh, device.name)
+
+    def __getattr__(self, name):
+        # Connection management and the persistent and connected attributes are passed through to the device
+        return getattr(self.device, name)
+
+    def __setattr__(self, name, value):
+        if name in {"device", "_fh", "_lock", "_started_at"}:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.device, name, value)
+
+    def __enter__(self):
+        self.device.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.device.__exit__(exc_type, exc_value, traceback)
+
+    def send_apdu(self, cla, ins, p1, p2, data, **kwargs):
+        started_at = time.perf_counter()
+        response, error = b"", None
+        try:
+            res = self.device.send_apdu(cla=cla, ins=ins, p1=p1, p2=p2, data=data, **kwargs)
+            # SCardReader reuses its receive buffer, so copy the response
+            response = bytes(res)
+            return res
+        except SCardError as e:
+            error = e.args[0].value if isinstance(e.args[0], SCardConstants.SCardStatus) else None
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            with self._lock:
+                write_record(self._fh, TraceRecord(started_at - self._started_at, duration, int(cla), int(ins),
+                                                   int(p1), int(p2), bytes(data), response, error))
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+class ReplayTransport(SCardConstants):
+    """
+    Replays a trace recorded with ``RecordingTransport`` through the ``SCardReader`` interface. Each exchange takes
+    its recorded duration divided by ``speed``; with ``speed=0``, exchanges return immediately. Errors recorded in
+    the trace, such as a card reset, are raised again. With ``strict``, each command must match the recorded one.
+    """
+    def __init__(self, path: str, speed: float = 1, strict: bool = True) -> None:
+        self._fh = open(path, "rb")
+        self.name, self._records = read_trace(self._fh)
+        self.speed = speed
+        self.strict = strict
+        self.persistent = False
+        self.connected = False
+        self.in_transaction = False
+        self.replayed = 0
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self, disposition=None):
+        self.connected = False
+        self.in_transaction = False
+
+    def reconnect(self):
+        self.connected = True
+
+    @contextmanager
+    def transaction(self):
+        self.in_transaction = True
+        try:
+            yield self
+        finally:
+            self.in_transaction = False
+
+    def cancel(self):
+        pass
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.persistent:
+            self.disconnect()
+
+    def send_apdu(self, cla, ins, p1, p2, data, **kwargs):
+        record = next(self._records, None)
+        if record is None:
+            raise ExileError("APDU trace exhausted after {} exchanges".format(self.replayed))
+        recorded = (record.cla, record.ins, record.p1, record.p2, record.data)
+        if self.strict and recorded != (cla, ins, p1, p2, bytes(data)):
+            raise ExileError("APDU {:02x}{:02x}{:02x}{:02x} does not match exchange {} in the trace".format(
+                cla, ins, p1, p2, self.replayed))
+        self.replayed += 1
+        if self.speed > 0:
+            time.sleep(record.duration / self.speed)
+        if record.error is not None:
+            raise SCardError(self.SCardStatus(record.error))
+        return record.response
+
+    def close(self):
+        self._fh.close()
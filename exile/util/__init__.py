@@ -0,0 +1,92 @@
+import time, threading, typing
+from collections import OrderedDict
+
+class ExpiringCache:
+    """
+    A thread-safe, size-bounded in-memory cache whose entries expire after ``ttl`` seconds. Values stored as
+    ``bytearray`` are overwritten with zeros when they expire or are evicted or purged; ``get()`` returns an immutable
+    copy of them so that a concurrent purge cannot change a value while it is in use. Expired entries are removed on
+    each access, and by a timer thread when the oldest entry expires, so they do not outlive their ``ttl`` if the cache
+    is not used again.
+    """
+    def __init__(self, ttl: float = 3600, max_entries: int = 64) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # type: OrderedDict
+        # Entries in the order they were set, which is the order in which they expire
+        self._expiry = OrderedDict()  # type: OrderedDict
+        self._timer = None  # type: typing.Optional[threading.Timer]
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            self._sweep()
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            value = self._entries[key]
+            return bytes(value) if isinstance(value, bytearray) else value
+
+    def set(self, key, value):
+        with self._lock:
+            self._sweep()
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = value
+            self._expiry[key] = time.monotonic() + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+            if self._timer is None:
+                self._schedule()
+
+    def purge(self, predicate=None):
+        """
+        Remove all entries, or only the entries whose key satisfies ``predicate``.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if predicate is None or predicate(key):
+                    self._discard(key)
+            if not self._expiry:
+                self._cancel_timer()
+
+    def _sweep(self):
+        now = time.monotonic()
+        while self._expiry and next(iter(self._expiry.values())) <= now:
+            self._discard(next(iter(self._expiry)))
+        if not self._expiry:
+            self._cancel_timer()
+
+    def _schedule(self):
+        if self._expiry:
+            self._timer = threading.Timer(max(next(iter(self._expiry.values())) - time.monotonic(), 0), self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+        else:
+            self._timer = None
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire(self):
+        with self._lock:
+            if self._timer is not threading.current_thread():
+                # This timer was cancelled, and possibly replaced, after it fired
+                return
+            self._sweep()
+            self._schedule()
+
+    def _discard(self, key):
+        del self._expiry[key]
+        zeroize(self._entries.pop(key))
+
+    def __len__(self):
+        with self._lock:
+            self._sweep()
+            return len(self._entries)
+
+def zeroize(value):
+    if isinstance(value, bytearray):
+        value[:] = bytes(len(value))
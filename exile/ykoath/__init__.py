@@ -1,109 +1,435 @@
-import base64, struct, typing, hashlib, hmac
-from collections import namedtuple
+import os, time, base64, struct, typing, hashlib, hmac, threading, logging
+from binascii import b2a_hex
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 from urllib.parse import urlparse, parse_qs
-from ..exceptions import YKOATHError
+from ..exceptions import ExileError, YKOATHError, SCardError
 from ..scard import i2b, SCardManager, SCardReader
+from ..scard.const import SCardConstants
+from ..util import ExpiringCache
+from .. import instrumentation
 from .const import YKOATHConstants
+from . import tlv
 
-YKOATHCredential = namedtuple("YKOATHCredential", ("name", "oath_type", "algorithm"))
+logger = logging.getLogger(__name__)
+
+YKOATHCredential = namedtuple("YKOATHCredential", ("name", "oath_type", "algorithm", "require_touch"))
+YKOATHCredential.__new__.__defaults__ = (None,)  # require_touch is None when the device has not reported it
+YKOATHPending = namedtuple("YKOATHPending", ("name", "digits", "require_touch"))
+
+class UnlockKeyCache(ExpiringCache):
+    """
+    Caches the PBKDF2-derived keys used to unlock password-protected devices, keyed by device ID and a keyed hash of
+    the password. Keys are overwritten with zeros when they expire or are purged.
+    """
+    _salt = os.urandom(32)
+
+    def cache_key(self, device_id: bytes, password: str):
+        return (device_id, hmac.new(self._salt, password.encode(), "sha256").digest())
+
+    def purge(self, device_id: bytes = None):
+        ExpiringCache.purge(self, None if device_id is None else lambda key: key[0] == device_id)
 
 class YKOATH(YKOATHConstants):
     """
     See https://developers.yubico.com/OATH/YKOATH_Protocol.html
     """
-    def __init__(self, device: SCardReader = None, password: str = None) -> None:
-        if device is None:
+    unlock_key_cache = None  # type: typing.Optional[UnlockKeyCache]
+    """Set to an ``UnlockKeyCache`` to avoid repeating the PBKDF2 key derivation for each session with a device."""
+    reader_monitor = None  # type: typing.Any
+    """Set to a started ``exile.scard.monitor.ReaderMonitor`` to look up devices without enumerating readers."""
+
+    @classmethod
+    def find_device(cls, device_prefix: str) -> SCardReader:
+        """
+        Return the first reader whose name starts with ``device_prefix``. With a reader monitor, wait for the device to
+        be attached for up to the monitor's timeout.
+        """
+        if cls.reader_monitor is not None:
+            reader = cls.reader_monitor.wait_for(device_prefix)
+            if reader is not None:
+                return reader
+        else:
             for reader in SCardManager():
-                if reader.name.lower().startswith(self.device_prefix):
-                    device = reader
-                    break
-            else:
-                raise YKOATHError("No YubiKey found")
+                if reader.name.lower().startswith(device_prefix):
+                    return reader
+        raise YKOATHError("No YubiKey found")
+
+    def __init__(self, device: SCardReader = None, password: str = None, persistent: bool = False) -> None:
+        if device is None:
+            device = self.find_device(self.device_prefix)
         self.device = device
-        res = self.send_apdu(cla=0, ins=self.Instruction.SELECT, p1=0x04, p2=0, data=self.Application.OATH)
-        _, self._version, res = self.parse_tlv(res, self.Tag.VERSION)
-        _, self._id, res = self.parse_tlv(res, self.Tag.NAME)
-        _, self._challenge, res = self.parse_tlv(res)
-        if self._challenge and password is not None:
-            self.validate(password)
+        if persistent:
+            self.device.persistent = True
+        self.lock = threading.RLock()
+        self._in_transaction = False
+        self._password = password
+        self._id = None  # type: typing.Optional[bytes]
+        self._credentials = None  # type: typing.Optional[OrderedDict]
+        self._needs_select = False
+        self.select()
 
-    def send_apdu(self, **kwargs):
-        with self.device:
-            res = self.device.send_apdu(**kwargs)
-            while res[-2:-1] == self.Response.MORE_DATA_AVAILABLE.value:
-                res = res[:-2] + self.device.send_apdu(cla=0, ins=self.Instruction.SEND_REMAINING, p1=0, p2=0, data=b"")
+    def select(self):
+        res = self._transmit(cla=0, ins=self.Instruction.SELECT, p1=0x04, p2=0, data=self.Application.OATH)
+        fields = dict(tlv.iterate(memoryview(res)[:-2]))
+        self._version = bytes(fields[self.Tag.VERSION])
+        if self._id != fields[self.Tag.NAME]:
+            self._id = bytes(fields[self.Tag.NAME])
+            self._credentials = None
+        self._challenge = bytes(fields.get(self.Tag.CHALLENGE, b""))
+        # Selecting the applet clears its authentication state
+        self._validated = not self._challenge
+        if self._challenge and self._password is not None:
+            self.validate(self._password)
+
+    def close(self):
+        self.device.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold exclusive access to the device, both from other threads using this object and from other applications, for
+        a sequence of APDU exchanges. Nested calls join the outer transaction.
+        """
+        with self.lock:
+            if self._in_transaction:
+                yield self
+                return
+            # A new connection under a persistent session means the card may have been reinserted since it was selected
+            reconnecting = self.device.persistent and not self.device.connected and self._id is not None
+            if not self.device.persistent:
+                # Nothing detects a card swapped between the connections of a session that is not persistent, so its
+                # credential index only lasts for one transaction
+                self._credentials = None
+            with self.device, self.device.transaction():
+                self._in_transaction = True
+                try:
+                    if reconnecting or self._needs_select:
+                        self._reselect()
+                    yield self
+                finally:
+                    self._in_transaction = False
+
+    _instruction_names = {value: name for name, value in vars(YKOATHConstants.Instruction).items()
+                          if not name.startswith("_")}
+
+    def _transmit(self, **kwargs):
+        event, continuations = None, 0
+        if instrumentation.hooks:
+            ins = kwargs["ins"]
+            name = "SELECT" if ins == self.Instruction.SELECT and kwargs["p1"] == 0x04 else self._instruction_names[ins]
+            event = instrumentation.start("ykoath", name)
+        try:
+            with self.transaction():
+                res = self.device.send_apdu(**kwargs)
+                if res[-2:-1] == self.Response.MORE_DATA_AVAILABLE.value:
+                    # The device's response buffer is reused by each exchange, so accumulate the chunks in one bytearray
+                    data = bytearray(res[:-2])
+                    while res[-2:-1] == self.Response.MORE_DATA_AVAILABLE.value:
+                        res = self.device.send_apdu(cla=0, ins=self.Instruction.SEND_REMAINING, p1=0, p2=0, data=b"")
+                        data += res[:-2]
+                        continuations += 1
+                    data += res[-2:]
+                    res = data
+                res = bytes(res)
+        except SCardError as e:
+            if event is not None:
+                instrumentation.end(event, status=getattr(e.args[0], "name", None), continuations=continuations,
+                                    error=e)
+            raise
+        if event is not None:
+            bytes_sent = 6 * (1 + continuations) + len(kwargs["data"])
+            instrumentation.end(event, status=b2a_hex(res[-2:]).decode(), bytes_sent=bytes_sent,
+                                bytes_received=len(res) + 2 * continuations, continuations=continuations)
         if res[-2:] != self.Response.SUCCESS.value:
-            raise YKOATHError(self.Response(res[-2:]))
+            try:
+                status = self.Response(res[-2:])  # type: typing.Any
+            except ValueError:
+                status = "Unexpected status word {}".format(b2a_hex(res[-2:]).decode())
+            raise YKOATHError(status)
         return res
 
+    def send_apdu(self, **kwargs):
+        try:
+            return self._transmit(**kwargs)
+        except SCardError as e:
+            if not (self.device.persistent and e.args[0] in self.card_state_changes):
+                raise
+            status = e.args[0]
+        # The card was reset or reinserted under a persistent session, so the applet is no longer selected
+        with self.lock:
+            if status == SCardConstants.SCardStatus.W_REMOVED_CARD:
+                self._credentials = None
+            try:
+                self.device.reconnect()
+                self.select()
+            except ExileError:
+                # The card is still out or not ready, so select the applet again before the next exchange
+                self._needs_select = True
+                raise
+            return self._transmit(**kwargs)
+
+    def _reselect(self):
+        self._needs_select = False
+        try:
+            self.select()
+        except ExileError:
+            self._needs_select = True
+            raise
+
     def parse_tlv(self, data, expect_tag=None):
-        assert isinstance(data, bytes)
-        tag, length = data[0], data[1]
-        if expect_tag:
-            assert tag == expect_tag
-        value, data = data[2:2 + length], data[2 + length:]
-        return tag, value, data
+        view = memoryview(data)
+        tag, value, offset = tlv.read(view, expect_tag=expect_tag)
+        return tag, value, view[offset:]
 
     def put(self, credential_name: str, secret: bytes, require_touch=False,
             oath_type=YKOATHConstants.OATHType.TOTP, algorithm=YKOATHConstants.Algorithm.SHA1, digits=6):
-        secret_header = i2b(oath_type.value | algorithm.value) + i2b(digits)
+        secret_header = bytes((oath_type.value | algorithm.value, digits))
         # secret = hmac_shorten_key(secret, algorithm)
         secret = secret.ljust(self.HMAC_MINIMUM_KEY_SIZE, b'\x00')
-        data = i2b(self.Tag.NAME) + i2b(len(credential_name)) + credential_name.encode()
-        data += i2b(self.Tag.KEY) + i2b(len(secret_header) + len(secret)) + secret_header + secret
+        items = [(self.Tag.NAME, credential_name.encode()),
+                 (self.Tag.KEY, (secret_header, secret))]  # type: typing.List[typing.Tuple[int, typing.Any]]
         if require_touch:
-            data += i2b(self.Tag.PROPERTY) + i2b(self.Properties.REQUIRE_TOUCH)
-        return self.send_apdu(cla=0, ins=self.Instruction.PUT, p1=0, p2=0, data=data)
+            items.append((self.Tag.PROPERTY, self.Properties.REQUIRE_TOUCH))
+        data = tlv.encode(*items)
+        with self.lock:
+            res = self.send_apdu(cla=0, ins=self.Instruction.PUT, p1=0, p2=0, data=data)
+            if self._credentials is not None:
+                self._credentials[credential_name] = YKOATHCredential(name=credential_name, oath_type=oath_type,
+                                                                      algorithm=algorithm,
+                                                                      require_touch=bool(require_touch))
+        return res
 
     def delete(self, credential_name: str):
-        data = i2b(self.Tag.NAME) + i2b(len(credential_name)) + credential_name.encode()
-        return self.send_apdu(cla=0, ins=self.Instruction.DELETE, p1=0, p2=0, data=data)
+        data = tlv.encode((self.Tag.NAME, credential_name.encode()))
+        with self.lock:
+            try:
+                return self.send_apdu(cla=0, ins=self.Instruction.DELETE, p1=0, p2=0, data=data)
+            finally:
+                if self._credentials is not None:
+                    self._credentials.pop(credential_name, None)
+
+    def put_many(self, credentials: typing.Iterable[typing.Mapping]) -> OrderedDict:
+        """
+        Write several credentials in one card transaction. Each item is a dict of ``put()`` arguments. Returns an
+        OrderedDict mapping each credential name to "written", or to the exception raised when writing it.
+        """
+        outcomes = OrderedDict()  # type: OrderedDict
+        with self.transaction():
+            for credential in credentials:
+                kwargs = dict(credential)
+                credential_name = kwargs.pop("credential_name")
+                try:
+                    self.put(credential_name, **kwargs)
+                    outcomes[credential_name] = "written"
+                except ExileError as e:
+                    outcomes[credential_name] = e
+        return outcomes
+
+    def _read_digits(self):
+        # LIST does not report the number of digits or the touch requirement, but CALCULATE_ALL reports both for TOTP
+        # credentials and the number of digits for HOTP credentials, without advancing HOTP counters
+        digits = {}
+        for name, result in self.calculate_all(int(time.time()) // 30).items():
+            digits[name] = result.digits if isinstance(result, YKOATHPending) else len(result)
+        return digits
+
+    def _is_current(self, existing, spec, digits):
+        if existing.oath_type != spec.get("oath_type", self.OATHType.TOTP):
+            return False
+        if existing.algorithm != spec.get("algorithm", self.Algorithm.SHA1):
+            return False
+        if digits != spec.get("digits", 6):
+            return False
+        if existing.require_touch is None:
+            # The touch requirement of HOTP credentials can not be read back
+            return not spec.get("require_touch", False)
+        return existing.require_touch == bool(spec.get("require_touch", False))
+
+    def sync(self, desired_state: typing.Mapping[str, typing.Mapping], prune: bool = False,
+             overwrite: bool = False) -> OrderedDict:
+        """
+        Make the credentials on the device match ``desired_state``, a mapping of credential names to dicts of the other
+        ``put()`` arguments, in one card transaction. Secrets can not be read back, so only credentials that are
+        missing or whose OATH type, algorithm, number of digits or touch requirement differ are written, unless
+        ``overwrite`` is set (for example, to rotate secrets). The touch requirement of HOTP credentials can not be
+        read back either, so HOTP credentials that require touch are written each time. With ``prune``, credentials
+        that are not in ``desired_state`` are deleted.
+
+        Returns an OrderedDict mapping credential names to "added", "updated", "unchanged" or "deleted", or to the
+        exception raised when writing or deleting the credential.
+        """
+        outcomes = OrderedDict()  # type: OrderedDict
+        with self.transaction():
+            self.invalidate_credentials()
+            current = OrderedDict(self.credentials)
+            digits = {}  # type: typing.Dict[str, int]
+            if not overwrite and any(credential_name in current for credential_name in desired_state):
+                digits = self._read_digits()
+                # CALCULATE_ALL also recorded the touch requirement of TOTP credentials in the index
+                current = OrderedDict(self.credentials)
+            for credential_name, spec in desired_state.items():
+                existing = current.get(credential_name)
+                current_digits = digits.get(credential_name)
+                if existing is not None and not overwrite and self._is_current(existing, spec, current_digits):
+                    outcomes[credential_name] = "unchanged"
+                    continue
+                try:
+                    self.put(credential_name, **spec)
+                    outcomes[credential_name] = "added" if existing is None else "updated"
+                except ExileError as e:
+                    outcomes[credential_name] = e
+            if prune:
+                for credential_name in current:
+                    if credential_name not in desired_state:
+                        try:
+                            self.delete(credential_name)
+                            outcomes[credential_name] = "deleted"
+                        except ExileError as e:
+                            outcomes[credential_name] = e
+        return outcomes
 
     def reset(self):
-        return self.send_apdu(cla=0, ins=self.Instruction.RESET, p1=0xde, p2=0xad, data=b"")
+        with self.lock:
+            res = self.send_apdu(cla=0, ins=self.Instruction.RESET, p1=0xde, p2=0xad, data=b"")
+            self.select()
+            self._credentials = OrderedDict()
+        return res
 
     def list(self):
         return self.send_apdu(cla=0, ins=self.Instruction.LIST, p1=0, p2=0, data=b"")
 
     def calculate(self, credential_name: str, challenge: typing.Union[bytes, int], want_truncated_response=True):
         chal_bytes = challenge if isinstance(challenge, bytes) else int_to_bytestring(challenge)
-        data = i2b(self.Tag.NAME) + i2b(len(credential_name)) + credential_name.encode()
-        data += i2b(self.Tag.CHALLENGE) + i2b(len(chal_bytes)) + chal_bytes
+        data = tlv.encode((self.Tag.NAME, credential_name.encode()), (self.Tag.CHALLENGE, chal_bytes))
         p2 = 0x01 if want_truncated_response else 0
-        res = self.send_apdu(cla=0, ins=self.Instruction.CALCULATE, p1=0, p2=p2, data=data)
-        assert res[0] == self.Tag.TRUNCATED_RESPONSE if want_truncated_response else self.Tag.RESPONSE
-        res_len, digits = res[1], res[2]
+        try:
+            res = self.send_apdu(cla=0, ins=self.Instruction.CALCULATE, p1=0, p2=p2, data=data)
+        except YKOATHError as e:
+            if e.args[0] == self.Response.NOT_FOUND and self._credentials is not None:
+                self._credentials.pop(credential_name, None)
+            raise
         if want_truncated_response:
-            return str(struct.unpack('>I', res[3:3 + res_len - 1])[0]).zfill(digits)
+            _, value, _ = tlv.read(res, expect_tag=self.Tag.TRUNCATED_RESPONSE)
+            return self._format_code(value[0], value[1:])
         else:
-            return res[3:3 + res_len - 1]
+            _, value, _ = tlv.read(res, expect_tag=self.Tag.RESPONSE)
+            return value[1:]
+
+    def _format_code(self, digits, truncated_response):
+        code = struct.unpack('>I', truncated_response)[0] & 0x7fffffff
+        return str(code % 10 ** digits).zfill(digits)
+
+    def calculate_all(self, challenge: typing.Union[bytes, int], want_truncated_response=True):
+        """
+        Calculate responses for all credentials with one CALCULATE_ALL exchange. Returns a dict mapping credential
+        names to responses. HOTP credentials and credentials that require touch are not calculated by the device; they
+        map to a ``YKOATHPending`` tuple and can be calculated individually with ``calculate()``.
+        """
+        chal_bytes = challenge if isinstance(challenge, bytes) else int_to_bytestring(challenge)
+        data = tlv.encode((self.Tag.CHALLENGE, chal_bytes))
+        p2 = 0x01 if want_truncated_response else 0
+        res = memoryview(self.send_apdu(cla=0, ins=self.Instruction.CALCULATE_ALL, p1=0, p2=p2, data=data))[:-2]
+        results = {}
+        offset = 0
+        while offset < len(res):
+            _, name_data, offset = tlv.read(res, offset, expect_tag=self.Tag.NAME)
+            tag, value, offset = tlv.read(res, offset)
+            name = str(name_data, "utf-8")
+            if tag == self.Tag.TRUNCATED_RESPONSE:
+                results[name] = self._format_code(value[0], value[1:])
+            elif tag == self.Tag.RESPONSE:
+                results[name] = bytes(value[1:])
+            else:
+                results[name] = YKOATHPending(name=name, digits=value[0], require_touch=tag == self.Tag.TOUCH)
+        with self.lock:
+            if self._credentials is not None:
+                for name, result in results.items():
+                    if name in self._credentials and not isinstance(result, YKOATHPending):
+                        self._credentials[name] = self._credentials[name]._replace(require_touch=False)
+                    elif name in self._credentials and result.require_touch:
+                        self._credentials[name] = self._credentials[name]._replace(require_touch=True)
+        return results
+
+    def _derive_key(self, password):
+        cache = YKOATH.unlock_key_cache
+        if cache is None:
+            return hashlib.pbkdf2_hmac('sha256', password.encode(), self._id, 1000)
+        cache_key = cache.cache_key(self._id, password)
+        key = cache.get(cache_key)
+        if key is None:
+            key = hashlib.pbkdf2_hmac('sha256', password.encode(), self._id, 1000)
+            cache.set(cache_key, bytearray(key))
+        return key
 
     def set_code(self, password):
-        key = hashlib.pbkdf2_hmac('sha256', password.encode(), self._id, 1000)
+        if YKOATH.unlock_key_cache is not None:
+            YKOATH.unlock_key_cache.purge(self._id)
+        key = self._derive_key(password)
         test_challenge = b'01234567'
         test_response = hmac.new(key, test_challenge, 'sha256').digest()
-        data = i2b(self.Tag.KEY) + i2b(len(key) + 1) + i2b(self.Algorithm.SHA256.value) + key
-        data += i2b(self.Tag.CHALLENGE) + i2b(len(test_challenge)) + test_challenge
-        data += i2b(self.Tag.RESPONSE) + i2b(len(test_response)) + test_response
-        return self.send_apdu(cla=0, ins=self.Instruction.SET_CODE, p1=0, p2=0, data=data)
+        data = tlv.encode((self.Tag.KEY, (i2b(self.Algorithm.SHA256.value), key)),
+                          (self.Tag.CHALLENGE, test_challenge),
+                          (self.Tag.RESPONSE, test_response))
+        res = self.send_apdu(cla=0, ins=self.Instruction.SET_CODE, p1=0, p2=0, data=data)
+        self._password = password
+        return res
 
     def validate(self, password):
-        key = hashlib.pbkdf2_hmac('sha256', password.encode(), self._id, 1000)
-        response = hmac.new(key, self._challenge, 'sha256').digest()
-        data = i2b(self.Tag.RESPONSE) + i2b(len(response)) + response
-        data += i2b(self.Tag.CHALLENGE) + i2b(len(self._challenge)) + self._challenge
-        return self.send_apdu(cla=0, ins=self.Instruction.VALIDATE, p1=0, p2=0, data=data)
+        """
+        Unlock a password-protected device. This is skipped if the session is already unlocked; the applet stays
+        unlocked until it is selected again, which happens after the card is reset or reinserted.
+        """
+        with self.lock:
+            self._password = password
+            if self._validated:
+                return None
+            key = self._derive_key(password)
+            response = hmac.new(key, self._challenge, 'sha256').digest()
+            data = tlv.encode((self.Tag.RESPONSE, response), (self.Tag.CHALLENGE, self._challenge))
+            res = self.send_apdu(cla=0, ins=self.Instruction.VALIDATE, p1=0, p2=0, data=data)
+            self._validated = True
+            return res
+
+    def _list_credentials(self):
+        for tag, value in tlv.iterate(memoryview(self.list())[:-2]):
+            if tag != self.Tag.NAME_LIST:
+                raise YKOATHError("Unexpected tag 0x{:02x} in LIST response".format(tag))
+            algorithm, oath_type = self.Algorithm(value[0] & 0x0f), self.OATHType(value[0] & 0xf0)
+            yield YKOATHCredential(name=str(value[1:], "utf-8"), oath_type=oath_type, algorithm=algorithm)
+
+    @property
+    def credentials(self) -> typing.Mapping[str, YKOATHCredential]:
+        """
+        An index of the credentials on the device, keyed by name. It is read from the device with LIST on first use,
+        kept up to date by ``put()``, ``delete()`` and ``reset()``, and discarded when a different or reinserted card is
+        detected. Call ``invalidate_credentials()`` if the credentials were changed by another application.
+
+        Only persistent sessions keep the index between transactions. A session that is not persistent reconnects for
+        each transaction and can not tell whether the card was swapped in between, so it reads the index again.
+        """
+        with self.lock:
+            if self._credentials is None or not (self.device.persistent or self._in_transaction):
+                self._credentials = OrderedDict((c.name, c) for c in self._list_credentials())
+            return self._credentials
+
+    def invalidate_credentials(self):
+        with self.lock:
+            self._credentials = None
+
+    def __contains__(self, credential_name):
+        return credential_name in self.credentials
 
     def __iter__(self):
-        res = self.list()[:-2]
-        while res:
-            name_tag, name_len, alg = res[0], res[1], res[2]
-            assert name_tag == self.Tag.NAME_LIST
-            algorithm, oath_type = self.Algorithm(alg & 0x0f), self.OATHType(alg & 0xf0)
-            name_data = res[3:3 + name_len - 1]
-            yield YKOATHCredential(name=name_data.decode(), oath_type=oath_type, algorithm=algorithm)
-            res = res[name_len + 2:]
+        with self.lock:
+            return iter(list(self.credentials.values()))
 
 def int_to_bytestring(i: int, padding=8):
     result = bytearray()
@@ -112,8 +438,72 @@ def int_to_bytestring(i: int, padding=8):
         i >>= 8
     return bytes(bytearray(reversed(result)).rjust(padding, b'\0'))
 
+class TOTPCache:
+    """
+    Caches the current codes for ``TOTP.get()``, keyed by device, time step and counter, so a code is only returned
+    during the time step it was calculated for. On a miss, the codes of all credentials that do not require touch are
+    fetched with one CALCULATE_ALL exchange; the code of a credential that requires touch is calculated, with a touch,
+    on its first read in each time step. During the last ``prefetch`` seconds of each time step, the codes for the
+    next one are fetched in a background thread, so reads do not wait for the device at the rollover.
+    """
+    def __init__(self, prefetch: float = 2) -> None:
+        self.prefetch = prefetch
+        self._codes = {}  # type: typing.Dict[tuple, typing.Dict[str, str]]
+        self._prefetching = set()  # type: typing.Set[tuple]
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def _fetch(self, totp, time_step, counter):
+        key = (totp._id, time_step, counter)
+        with self._fetch_lock:
+            with self._lock:
+                if key in self._codes:
+                    return self._codes[key]
+            results = totp.calculate_all(counter)
+            codes = {label: code for label, code in results.items() if not isinstance(code, YKOATHPending)}
+            with self._lock:
+                # Codes for earlier time steps are no longer valid
+                for cached_key in [k for k in self._codes if k[1] == time_step and k[2] < counter - 1]:
+                    del self._codes[cached_key]
+                self._codes.setdefault(key, {}).update(codes)
+                return self._codes[key]
+
+    def _prefetch(self, totp, time_step, counter):
+        try:
+            self._fetch(totp, time_step, counter)
+        except ExileError as e:
+            logger.debug("Could not prefetch TOTP codes: %s", e)
+        finally:
+            with self._lock:
+                self._prefetching.discard((totp._id, time_step, counter))
+
+    def get(self, totp, label: str, time_step: int) -> str:
+        now = time.time()
+        counter = int(now / time_step)
+        with self._lock:
+            code = self._codes.get((totp._id, time_step, counter), {}).get(label)
+            next_key = (totp._id, time_step, counter + 1)
+            if now >= (counter + 1) * time_step - self.prefetch and next_key not in self._codes and \
+                    next_key not in self._prefetching:
+                self._prefetching.add(next_key)
+                threading.Thread(target=self._prefetch, args=(totp, time_step, counter + 1), daemon=True).start()
+        if code is None:
+            code = self._fetch(totp, time_step, counter).get(label)
+        if code is None:
+            # The credential requires touch, or is not a TOTP credential
+            code = totp.calculate(label, counter)
+            with self._lock:
+                self._codes.setdefault((totp._id, time_step, counter), {})[label] = code
+        return code
+
+    def clear(self):
+        with self._lock:
+            self._codes.clear()
+
 class TOTP(YKOATH):
     default_time_step = 30
+    code_cache = None  # type: typing.Optional[TOTPCache]
+    """Set to a ``TOTPCache`` to serve ``get()`` calls for the current time from memory."""
 
     def save(self, label: str, secret: str):
         self.put(label, base64.b32decode(secret, casefold=True))
@@ -128,9 +518,35 @@ class TOTP(YKOATH):
 
     def get(self, label: str, at: datetime = None, time_step: int = default_time_step):
         if at is None:
+            if self.code_cache is not None:
+                return self.code_cache.get(self, label, time_step)
             at = datetime.now()
         return self.calculate(label, int(at.timestamp() / time_step))
 
-    def verify(self, code: str, label: str, at: datetime = None, time_step: int = default_time_step):
-        if self.get(label=label, at=at, time_step=time_step) != code:
+    def get_all(self, at: datetime = None, time_step: int = default_time_step):
+        """
+        Return a dict mapping labels to codes for all credentials, using a single device exchange. Entries that cannot
+        be calculated without a touch or a counter are reported as ``YKOATHPending``.
+        """
+        if at is None:
+            at = datetime.now()
+        return self.calculate_all(int(at.timestamp() / time_step))
+
+    def verify(self, code: str, label: str, at: datetime = None, time_step: int = default_time_step, window: int = 0):
+        """
+        Verify a code, accepting codes up to ``window`` time steps before or after ``at`` to tolerate clock skew. All
+        candidate codes are calculated in one card transaction and compared in constant time. Returns the offset, in
+        time steps, of the matching code, so callers can track drift. Raises YKOATHError if no candidate matches.
+        """
+        if at is None:
+            at = datetime.now()
+        counter = int(at.timestamp() / time_step)
+        with self.transaction():
+            candidates = [(offset, self.calculate(label, counter + offset)) for offset in range(-window, window + 1)]
+        match = None
+        for offset, candidate in candidates:
+            if hmac.compare_digest(candidate.encode(), code.encode()) and (match is None or abs(offset) < abs(match)):
+                match = offset
+        if match is None:
             raise YKOATHError("TOTP code mismatch")
+        return match
@@ -0,0 +1,55 @@
+import asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+from . import YKOATH
+
+class AsyncYKOATH:
+    """
+    An asyncio interface to a YKOATH session. PC/SC calls run on a dedicated single-thread executor, so operations
+    that wait for a touch do not block the event loop. Cancelling an awaited operation only abandons its result: an
+    APDU exchange can not be interrupted, so the operation keeps the executor thread until the card answers, and later
+    operations wait for it.
+    """
+    def __init__(self, ykoath: YKOATH, executor: ThreadPoolExecutor = None) -> None:
+        self.ykoath = ykoath
+        self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="exile")
+
+    @classmethod
+    async def open(cls, device=None, password: str = None, executor: ThreadPoolExecutor = None):
+        executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix="exile")
+        loop = asyncio.get_running_loop()
+        ykoath = await loop.run_in_executor(executor, functools.partial(YKOATH, device=device, password=password,
+                                                                        persistent=True))
+        return cls(ykoath, executor=executor)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+
+    async def calculate(self, credential_name: str, challenge, want_truncated_response=True):
+        return await self._run(self.ykoath.calculate, credential_name, challenge,
+                               want_truncated_response=want_truncated_response)
+
+    async def calculate_all(self, challenge, want_truncated_response=True):
+        return await self._run(self.ykoath.calculate_all, challenge, want_truncated_response=want_truncated_response)
+
+    async def put(self, credential_name: str, secret: bytes, **kwargs):
+        return await self._run(self.ykoath.put, credential_name, secret, **kwargs)
+
+    async def delete(self, credential_name: str):
+        return await self._run(self.ykoath.delete, credential_name)
+
+    async def list(self):
+        """
+        Return the credentials stored on the device as a list of ``YKOATHCredential`` tuples.
+        """
+        return await self._run(list, self.ykoath)
+
+    async def close(self):
+        await self._run(self.ykoath.close)
+        self.executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
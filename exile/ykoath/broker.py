@@ -0,0 +1,55 @@
+import threading, typing
+from ..exceptions import YKOATHError
+from ..scard import SCardManager
+from . import YKOATH
+
+class YKOATHBroker:
+    """
+    Process-wide owner of YKOATH sessions, one per reader. Sessions are persistent and serialize APDU exchanges with
+    a lock and a card transaction, so they can be shared by any number of threads and signers.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._manager = None  # type: typing.Optional[SCardManager]
+        self._sessions = {}  # type: dict
+
+    def get(self, device_prefix: str = YKOATH.device_prefix, password: str = None) -> YKOATH:
+        """
+        Return the shared session for the first reader whose name starts with ``device_prefix``, opening it if
+        necessary. ``password`` is only used when the session is opened.
+        """
+        with self._lock:
+            for name, ykoath in self._sessions.items():
+                if name.lower().startswith(device_prefix):
+                    return ykoath
+            if YKOATH.reader_monitor is not None:
+                reader = YKOATH.find_device(device_prefix)
+            else:
+                if self._manager is None:
+                    self._manager = SCardManager()
+                for reader in self._manager:
+                    if reader.name.lower().startswith(device_prefix):
+                        break
+                else:
+                    raise YKOATHError("No YubiKey found")
+            ykoath = YKOATH(device=reader, password=password, persistent=True)
+            self._sessions[reader.name] = ykoath
+            return ykoath
+
+    def discard(self, ykoath: YKOATH):
+        """
+        Close a session, for example after its device was removed. The next ``get()`` opens a new one.
+        """
+        with self._lock:
+            self._sessions.pop(ykoath.device.name, None)
+        with ykoath.lock:
+            ykoath.close()
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for ykoath in sessions:
+            with ykoath.lock:
+                ykoath.close()
+
+broker = YKOATHBroker()
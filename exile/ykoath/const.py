@@ -1,8 +1,10 @@
 from enum import Enum
+from ..scard.const import SCardConstants
 
 class YKOATHConstants:
     device_prefix = "yubico yubikey"
     HMAC_MINIMUM_KEY_SIZE = 14
+    card_state_changes = {SCardConstants.SCardStatus.W_RESET_CARD, SCardConstants.SCardStatus.W_REMOVED_CARD}
 
     class Tag:
         NAME = 0x71
@@ -0,0 +1,269 @@
+import os, time, hmac, struct, threading, typing
+from collections import OrderedDict
+from contextlib import contextmanager
+from ..exceptions import SCardError
+from ..scard import i2b
+from ..scard.const import SCardConstants
+from .const import YKOATHConstants
+from . import tlv
+
+class _EmulatedCredential:
+    def __init__(self, oath_type, algorithm, digits, key, require_touch=False, counter=0):
+        self.oath_type = oath_type
+        self.algorithm = algorithm
+        self.digits = digits
+        self.key = key
+        self.require_touch = require_touch
+        self.counter = counter
+
+class YKOATHEmulator(SCardConstants, YKOATHConstants):
+    """
+    A software implementation of the YKOATH applet with the same interface as ``SCardReader``, for testing and
+    benchmarking without a YubiKey::
+
+        ykoath = YKOATH(device=YKOATHEmulator(latency=0.002))
+
+    ``latency`` seconds are spent on each APDU exchange, and ``touch_delay`` seconds on each calculation with a
+    credential that requires touch. Responses longer than ``max_response_size`` bytes are split into chunks retrieved
+    with SEND_REMAINING, like the YubiKey does. ``reset_card()``, ``remove_card()`` and ``insert_card()`` simulate
+    other applications resetting the card and the card being unplugged.
+    """
+    MAX_NAME_LENGTH = 64
+    hash_names = {YKOATHConstants.Algorithm.SHA1: "sha1",
+                  YKOATHConstants.Algorithm.SHA256: "sha256",
+                  YKOATHConstants.Algorithm.SHA512: "sha512"}
+
+    def __init__(self, name: str = "Yubico YubiKey OTP+FIDO+CCID (emulated)", version: bytes = b"\x05\x02\x04",
+                 latency: float = 0, touch_delay: float = 0, max_response_size: int = 256) -> None:
+        self.name = name
+        self.version = version
+        self.latency = latency
+        self.touch_delay = touch_delay
+        self.max_response_size = max_response_size
+        self.persistent = False
+        self.connected = False
+        self.in_transaction = False
+        self.apdu_count = 0
+        self.connect_count = 0
+        self._lock = threading.Lock()
+        self._present = True
+        self._pending_error = None  # type: typing.Optional[SCardError]
+        self._reset_applet()
+
+    def _reset_applet(self):
+        self.credentials = OrderedDict()  # type: OrderedDict
+        self.device_id = os.urandom(8)
+        self.access_key = None  # type: bytes
+        self._deselect()
+
+    def _deselect(self):
+        self.selected = False
+        self.validated = False
+        self._challenge = None  # type: bytes
+        self._remaining = b""
+
+    def reset_card(self):
+        self._deselect()
+        self._pending_error = SCardError(self.SCardStatus.W_RESET_CARD)
+
+    def remove_card(self):
+        self._deselect()
+        self._present = False
+        self._pending_error = SCardError(self.SCardStatus.W_REMOVED_CARD)
+
+    def insert_card(self):
+        self._present = True
+
+    # SCardReader interface
+
+    def connect(self):
+        # Like SCardConnect, this is not called again on an open handle, so a removal is reported by send_apdu()
+        if not self.connected:
+            if not self._present:
+                raise SCardError(self.SCardStatus.E_NO_SMARTCARD)
+            self.connected = True
+            self.connect_count += 1
+            self._pending_error = None
+
+    def disconnect(self, disposition=None):
+        self.connected = False
+        self.in_transaction = False
+
+    def reconnect(self):
+        self.connected = False
+        self.connect()
+
+    @contextmanager
+    def transaction(self):
+        self.in_transaction = True
+        try:
+            yield self
+        finally:
+            self.in_transaction = False
+
+    def cancel(self):
+        pass
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.persistent:
+            self.disconnect()
+
+    def send_apdu(self, cla, ins, p1, p2, data):
+        if not self.connected:
+            raise SCardError(self.SCardStatus.E_INVALID_HANDLE)
+        if len(data) > 0xff:
+            raise SCardError(self.SCardStatus.E_INVALID_PARAMETER)
+        if self._pending_error is not None:
+            raise self._pending_error
+        with self._lock:
+            self.apdu_count += 1
+            if self.latency:
+                time.sleep(self.latency)
+            if ins == self.Instruction.SEND_REMAINING and self._remaining:
+                return self._respond(self._remaining)
+            self._remaining = b""
+            try:
+                return self._respond(self._dispatch(ins, p1, p2, bytes(data)))
+            except _StatusWord as e:
+                return e.args[0]
+
+    # YKOATH applet
+
+    def _respond(self, data):
+        chunk, self._remaining = data[:self.max_response_size], data[self.max_response_size:]
+        if self._remaining:
+            return chunk + self.Response.MORE_DATA_AVAILABLE.value + i2b(min(len(self._remaining), 0xff))
+        return chunk + self.Response.SUCCESS.value
+
+    def _dispatch(self, ins, p1, p2, data):
+        if ins == self.Instruction.SELECT and p1 == 0x04:
+            return self._select(data)
+        if not self.selected:
+            raise _StatusWord(b"\x6d\x00")
+        if ins == self.Instruction.VALIDATE:
+            return self._validate(data)
+        if ins == self.Instruction.RESET:
+            if (p1, p2) != (0xde, 0xad):
+                raise _StatusWord(self.Response.WRONG_SYNTAX.value)
+            self._reset_applet()
+            self.selected = True
+            return b""
+        if self.access_key is not None and not self.validated:
+            raise _StatusWord(self.Response.AUTH_REQUIRED.value)
+        handler = {self.Instruction.PUT: self._put,
+                   self.Instruction.DELETE: self._delete,
+                   self.Instruction.SET_CODE: self._set_code,
+                   self.Instruction.LIST: self._list,
+                   self.Instruction.CALCULATE: self._calculate,
+                   self.Instruction.CALCULATE_ALL: self._calculate_all}.get(ins)
+        if handler is None:
+            raise _StatusWord(b"\x6d\x00")
+        return handler(p1, p2, data)
+
+    def _parse(self, data):
+        return OrderedDict((tag, bytes(value)) for tag, value in tlv.iterate(data, short_tags=(self.Tag.PROPERTY,)))
+
+    def _tlv(self, tag, value):
+        return tlv.encode((tag, value))
+
+    def _select(self, data):
+        if data != self.Application.OATH:
+            raise _StatusWord(self.Response.NOT_FOUND.value)
+        self._deselect()
+        self.selected = True
+        res = self._tlv(self.Tag.VERSION, self.version) + self._tlv(self.Tag.NAME, self.device_id)
+        if self.access_key is not None:
+            self._challenge = os.urandom(8)
+            res += self._tlv(self.Tag.CHALLENGE, self._challenge)
+            res += self._tlv(self.Tag.ALGORITHM, i2b(self.Algorithm.SHA256.value))
+        return res
+
+    def _validate(self, data):
+        fields = self._parse(data)
+        if self.access_key is None or self._challenge is None:
+            raise _StatusWord(self.Response.WRONG_SYNTAX.value)
+        expected = hmac.new(self.access_key, self._challenge, "sha256").digest()
+        if not hmac.compare_digest(expected, fields.get(self.Tag.RESPONSE, b"")):
+            raise _StatusWord(self.Response.NOT_FOUND.value)
+        self.validated = True
+        self._challenge = None
+        return self._tlv(self.Tag.RESPONSE, hmac.new(self.access_key, fields[self.Tag.CHALLENGE], "sha256").digest())
+
+    def _set_code(self, p1, p2, data):
+        fields = self._parse(data)
+        key = fields[self.Tag.KEY]
+        if not key:
+            self.access_key = None
+            return b""
+        access_key = key[1:]
+        expected = hmac.new(access_key, fields[self.Tag.CHALLENGE], "sha256").digest()
+        if not hmac.compare_digest(expected, fields[self.Tag.RESPONSE]):
+            raise _StatusWord(self.Response.WRONG_SYNTAX.value)
+        self.access_key = access_key
+        return b""
+
+    def _put(self, p1, p2, data):
+        fields = self._parse(data)
+        if len(fields[self.Tag.NAME]) > self.MAX_NAME_LENGTH:
+            raise _StatusWord(self.Response.WRONG_SYNTAX.value)
+        key = fields[self.Tag.KEY]
+        properties = fields.get(self.Tag.PROPERTY, b"\0")[0]
+        credential = _EmulatedCredential(oath_type=self.OATHType(key[0] & 0xf0),
+                                         algorithm=self.Algorithm(key[0] & 0x0f),
+                                         digits=key[1],
+                                         key=key[2:],
+                                         require_touch=bool(properties & self.Properties.REQUIRE_TOUCH))
+        if self.Tag.IMF in fields:
+            credential.counter = int.from_bytes(fields[self.Tag.IMF], "big")
+        self.credentials[fields[self.Tag.NAME]] = credential
+        return b""
+
+    def _delete(self, p1, p2, data):
+        name = self._parse(data)[self.Tag.NAME]
+        if name not in self.credentials:
+            raise _StatusWord(self.Response.NOT_FOUND.value)
+        del self.credentials[name]
+        return b""
+
+    def _list(self, p1, p2, data):
+        return b"".join(self._tlv(self.Tag.NAME_LIST, i2b(c.oath_type.value | c.algorithm.value) + name)
+                        for name, c in self.credentials.items())
+
+    def _compute(self, credential, challenge, truncate):
+        if credential.require_touch and self.touch_delay:
+            time.sleep(self.touch_delay)
+        if credential.oath_type == self.OATHType.HOTP:
+            challenge = struct.pack(">Q", credential.counter)
+            credential.counter += 1
+        digest = hmac.new(credential.key, challenge, self.hash_names[credential.algorithm]).digest()
+        if not truncate:
+            return self._tlv(self.Tag.RESPONSE, i2b(credential.digits) + digest)
+        offset = digest[-1] & 0x0f
+        return self._tlv(self.Tag.TRUNCATED_RESPONSE, i2b(credential.digits) + digest[offset:offset + 4])
+
+    def _calculate(self, p1, p2, data):
+        fields = self._parse(data)
+        credential = self.credentials.get(fields[self.Tag.NAME])
+        if credential is None:
+            raise _StatusWord(self.Response.NOT_FOUND.value)
+        return self._compute(credential, fields.get(self.Tag.CHALLENGE, b""), truncate=p2 == 0x01)
+
+    def _calculate_all(self, p1, p2, data):
+        challenge = self._parse(data)[self.Tag.CHALLENGE]
+        res = b""
+        for name, credential in self.credentials.items():
+            res += self._tlv(self.Tag.NAME, name)
+            if credential.oath_type == self.OATHType.HOTP:
+                res += self._tlv(self.Tag.NO_RESPONSE, i2b(credential.digits))
+            elif credential.require_touch:
+                res += self._tlv(self.Tag.TOUCH, i2b(credential.digits))
+            else:
+                res += self._compute(credential, challenge, truncate=p2 == 0x01)
+        return res
+
+class _StatusWord(Exception):
+    pass
@@ -0,0 +1,152 @@
+import time, threading, logging, typing
+from concurrent.futures import ThreadPoolExecutor
+from ..exceptions import YKOATHError, SCardError
+from ..scard import SCardManager, SCardReader
+from . import YKOATH
+
+logger = logging.getLogger(__name__)
+
+class YKOATHPoolMember:
+    def __init__(self, ykoath: YKOATH) -> None:
+        self.ykoath = ykoath
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @property
+    def healthy(self):
+        return self.failures == 0
+
+    def health(self):
+        return dict(healthy=self.healthy, in_flight=self.in_flight, calls=self.calls, failures=self.failures)
+
+class YKOATHPool:
+    """
+    Dispatches operations across all YubiKeys whose reader name starts with ``device_prefix``. The keys are expected
+    to hold the same credentials. Each call goes to the healthy device with the fewest operations in flight. A device
+    that fails with a PC/SC error is taken out of rotation and retried after ``retry_interval`` seconds, doubling with
+    each consecutive failure; devices that are removed are dropped when the reader list is refreshed.
+
+    If ``devices`` is given, the pool is made of those readers (or emulators) instead of the attached readers, and
+    ``device_prefix`` is not used.
+    """
+    def __init__(self, device_prefix: str = YKOATH.device_prefix, password: str = None,
+                 retry_interval: float = 5, max_retry_interval: float = 300,
+                 devices: typing.Iterable[SCardReader] = None) -> None:
+        self.device_prefix = device_prefix
+        self.password = password
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.devices = list(devices) if devices is not None else None
+        self.manager = SCardManager() if devices is None else None
+        self.members = {}  # type: dict
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Open sessions to newly attached devices and drop devices whose readers are gone.
+        """
+        if self.devices is not None:
+            readers = self.devices
+        elif YKOATH.reader_monitor is not None:
+            readers = YKOATH.reader_monitor.find_all(self.device_prefix)
+        else:
+            readers = [r for r in self.manager if r.name.lower().startswith(self.device_prefix)]
+        with self._lock:
+            names = {reader.name for reader in readers}
+            for name in list(self.members):
+                if name not in names and self.members[name].in_flight == 0:
+                    del self.members[name]
+            new_readers = [reader for reader in readers if reader.name not in self.members]
+        for reader in new_readers:
+            try:
+                member = YKOATHPoolMember(YKOATH(device=reader, password=self.password, persistent=True))
+            except (SCardError, YKOATHError) as e:
+                logger.debug("Skipping %s: %s", reader.name, e)
+                continue
+            with self._lock:
+                self.members[reader.name] = member
+
+    def health(self):
+        with self._lock:
+            return {name: member.health() for name, member in self.members.items()}
+
+    def _acquire(self, exclude):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [m for m in self.members.values() if m not in exclude and m.retry_at <= now]
+            if not candidates:
+                return None
+            member = min(candidates, key=lambda m: (m.failures, m.in_flight))
+            member.in_flight += 1
+            return member
+
+    def _release(self, member, failed=False):
+        with self._lock:
+            member.in_flight -= 1
+            member.calls += 1
+            if failed:
+                member.failures += 1
+                backoff = self.retry_interval * 2 ** (member.failures - 1)
+                member.retry_at = time.monotonic() + min(backoff, self.max_retry_interval)
+            else:
+                member.failures = 0
+
+    def dispatch(self, operation: typing.Callable[[YKOATH], typing.Any]):
+        """
+        Run ``operation`` with the least busy healthy device, failing over to the other devices on PC/SC errors.
+        """
+        tried = set()  # type: set
+        refreshed = False
+        while True:
+            member = self._acquire(exclude=tried)
+            if member is None:
+                if refreshed:
+                    raise YKOATHError("No YubiKey available")
+                self.refresh()
+                refreshed = True
+                continue
+            try:
+                result = operation(member.ykoath)
+            except SCardError as e:
+                logger.debug("Taking %s out of rotation: %s", member.ykoath.device.name, e)
+                self._release(member, failed=True)
+                tried.add(member)
+                continue
+            except BaseException:
+                self._release(member)
+                raise
+            self._release(member)
+            return result
+
+    def sync(self, desired_state: typing.Mapping[str, typing.Mapping], max_workers: int = None, **kwargs):
+        """
+        Run ``YKOATH.sync()`` on every device in the pool in parallel. Returns a dict mapping each reader name to the
+        outcomes for that device, or to the exception raised if the device could not be synced.
+        """
+        self.refresh()
+        with self._lock:
+            members = dict(self.members)
+        results = {}  # type: dict
+        if not members:
+            return results
+        with ThreadPoolExecutor(max_workers=max_workers or len(members), thread_name_prefix="exile-sync") as executor:
+            futures = {name: executor.submit(member.ykoath.sync, desired_state, **kwargs)
+                       for name, member in members.items()}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except (SCardError, YKOATHError) as e:
+                    results[name] = e
+        return results
+
+    def calculate(self, *args, **kwargs):
+        return self.dispatch(lambda ykoath: ykoath.calculate(*args, **kwargs))
+
+    def list(self):
+        return self.dispatch(lambda ykoath: ykoath.list())
+
+    def __iter__(self):
+        return iter(self.dispatch(list))
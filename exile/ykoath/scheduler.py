@@ -0,0 +1,233 @@
+import time, heapq, itertools, threading, logging, typing, concurrent.futures
+from collections import OrderedDict, deque
+from contextlib import ExitStack
+from concurrent.futures import Future
+from ..exceptions import ExileError
+from . import YKOATH
+
+logger = logging.getLogger(__name__)
+
+class _Operation:
+    def __init__(self, key) -> None:
+        self.key = key
+        self.futures = []  # type: typing.List[Future]
+        self.running = False
+        self.cancelled = False
+        self.done = False
+
+class YKOATHScheduler:
+    """
+    Queues calculate requests for a YKOATH session and executes them one at a time in a worker thread, taking turns
+    between credentials so that a request waiting for a touch does not hold up the queue of another credential for
+    longer than one operation. Identical concurrent requests (same credential, challenge and response type) are
+    coalesced into one device operation, so a burst of requests for the same value costs one touch.
+
+    ``on_touch_pending(credential_name)`` is called from a scheduler thread when an operation that needs a touch
+    starts. If the session does not know whether a credential requires touch, it is called once the operation has run
+    for ``touch_detect_delay`` seconds.
+
+    A request with a ``timeout`` fails with ``concurrent.futures.TimeoutError`` when its deadline passes. When every
+    request coalesced into an operation has timed out, the operation is dropped from the queue. An operation that is
+    already running can not be interrupted (SCardCancel does not abort an APDU exchange): it keeps the worker, and the
+    session's lock, until the card answers, for example when the touch times out on the device, and its result is
+    discarded.
+
+    Queued operations, up to ``max_batch`` at a time, are executed back to back in one card transaction. With a
+    ``batch_window``, the worker waits that many seconds after the first request arrives to collect more requests into
+    the batch.
+
+    ``ykoath`` can also be a ``YKOATHPool`` or any object with the same ``calculate()`` method.
+    """
+    def __init__(self, ykoath: YKOATH, on_touch_pending: typing.Callable = None, touch_detect_delay: float = 0.5,
+                 batch_window: float = 0, max_batch: int = 64) -> None:
+        self.ykoath = ykoath
+        self.on_touch_pending = on_touch_pending
+        self.touch_detect_delay = touch_detect_delay
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._condition = threading.Condition()
+        self._queues = OrderedDict()  # type: OrderedDict
+        self._operations = {}  # type: dict
+        self._timers = []  # type: list
+        self._sequence = itertools.count()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run_worker, name="exile-scheduler", daemon=True)
+        self._timer_thread = threading.Thread(target=self._run_timers, name="exile-scheduler-timers", daemon=True)
+        self._worker.start()
+        self._timer_thread.start()
+
+    def _coalescable(self, credential_name):
+        # HOTP calculations advance the counter, so each request needs its own operation
+        credentials = getattr(self.ykoath, "_credentials", None)
+        credential = credentials.get(credential_name) if credentials is not None else None
+        return credential is None or credential.oath_type != YKOATH.OATHType.HOTP
+
+    def submit(self, credential_name: str, challenge: typing.Union[bytes, int], want_truncated_response=True,
+               timeout: float = None) -> Future:
+        """
+        Queue a calculation and return a future for its result.
+        """
+        chal_bytes = challenge if isinstance(challenge, bytes) else challenge.to_bytes(8, byteorder="big")
+        key = (credential_name, chal_bytes, want_truncated_response)
+        future = Future()  # type: Future
+        with self._condition:
+            if self._closed:
+                raise ExileError("Scheduler is closed")
+            operation = self._operations.get(key)
+            if operation is None or operation.cancelled or not self._coalescable(credential_name):
+                operation = _Operation(key)
+                self._operations[key] = operation
+                self._queues.setdefault(credential_name, deque()).append(operation)
+            operation.futures.append(future)
+            if timeout is not None:
+                self._schedule(timeout, self._expire, operation, future)
+            self._condition.notify_all()
+        return future
+
+    def calculate(self, credential_name: str, challenge: typing.Union[bytes, int], want_truncated_response=True,
+                  timeout: float = None):
+        return self.submit(credential_name, challenge, want_truncated_response=want_truncated_response,
+                           timeout=timeout).result()
+
+    def __iter__(self):
+        return iter(self.ykoath)
+
+    def pending(self):
+        """
+        Return the number of queued and running operations for each credential.
+        """
+        with self._condition:
+            counts = {}  # type: typing.Dict[str, int]
+            for operation in self._operations.values():
+                counts[operation.key[0]] = counts.get(operation.key[0], 0) + 1
+            return counts
+
+    def close(self):
+        """
+        Stop the scheduler after the queued operations are done.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+        self._timer_thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _schedule(self, delay, action, *args):
+        heapq.heappush(self._timers, (time.monotonic() + delay, next(self._sequence), action, args))
+        self._condition.notify_all()
+
+    def _run_timers(self):
+        with self._condition:
+            while not (self._closed and not self._operations):
+                if self._timers and self._timers[0][0] <= time.monotonic():
+                    _, _, action, args = heapq.heappop(self._timers)
+                    try:
+                        action(*args)
+                    except Exception:
+                        logger.exception("Scheduler timer failed")
+                else:
+                    self._condition.wait(self._timers[0][0] - time.monotonic() if self._timers else None)
+
+    def _expire(self, operation, future):
+        if future.done():
+            return
+        operation.futures.remove(future)
+        future.set_exception(concurrent.futures.TimeoutError("Deadline exceeded for {}".format(operation.key[0])))
+        if operation.futures or operation.done:
+            return
+        operation.cancelled = True
+        if not operation.running:
+            queue = self._queues.get(operation.key[0])
+            if queue is not None and operation in queue:
+                queue.remove(operation)
+                if not queue:
+                    del self._queues[operation.key[0]]
+            self._finish(operation)
+
+    def _notify_touch(self, operation):
+        if operation.running and not operation.done and self.on_touch_pending is not None:
+            try:
+                self.on_touch_pending(operation.key[0])
+            except Exception:
+                logger.exception("Touch notification callback failed")
+
+    def _finish(self, operation):
+        operation.done = True
+        if self._operations.get(operation.key) is operation:
+            del self._operations[operation.key]
+        self._condition.notify_all()
+
+    def _queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _run_worker(self):
+        while True:
+            with self._condition:
+                while not self._queues and not self._closed:
+                    self._condition.wait()
+                if not self._queues:
+                    return
+                if self.batch_window:
+                    deadline = time.monotonic() + self.batch_window
+                    while not self._closed and self._queued() < self.max_batch and time.monotonic() < deadline:
+                        self._condition.wait(deadline - time.monotonic())
+                batch = []
+                while self._queues and len(batch) < self.max_batch:
+                    # Take turns between credentials
+                    credential_name, queue = next(iter(self._queues.items()))
+                    batch.append(queue.popleft())
+                    if queue:
+                        self._queues.move_to_end(credential_name)
+                    else:
+                        del self._queues[credential_name]
+            self._execute_batch(batch)
+
+    def _execute_batch(self, batch):
+        with ExitStack() as stack:
+            if len(batch) > 1 and hasattr(self.ykoath, "transaction"):
+                try:
+                    stack.enter_context(self.ykoath.transaction())
+                except ExileError as e:
+                    # Each operation reports its own error
+                    logger.debug("Could not begin transaction: %s", e)
+            for operation in batch:
+                with self._condition:
+                    if operation.cancelled:
+                        continue
+                    operation.running = True
+                self._execute(operation)
+
+    def _require_touch(self, credential_name):
+        try:
+            return self.ykoath.credentials[credential_name].require_touch
+        except (ExileError, KeyError, AttributeError):
+            return None
+
+    def _execute(self, operation):
+        credential_name, challenge, want_truncated_response = operation.key
+        require_touch = self._require_touch(credential_name)
+        with self._condition:
+            if require_touch:
+                self._notify_touch(operation)
+            elif require_touch is None:
+                self._schedule(self.touch_detect_delay, self._notify_touch, operation)
+        result, error = None, None  # type: typing.Tuple[typing.Any, typing.Optional[Exception]]
+        try:
+            result = self.ykoath.calculate(credential_name, challenge, want_truncated_response=want_truncated_response)
+        except Exception as e:
+            error = e
+        with self._condition:
+            for future in operation.futures:
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+            self._finish(operation)
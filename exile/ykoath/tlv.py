@@ -0,0 +1,80 @@
+"""
+Encoder and decoder for the BER-TLV structures used by the YKOATH protocol, with support for multi-byte lengths.
+
+Decoding returns values as slices of the input, so iterating over a memoryview yields values without copying.
+Encoding computes each header once and joins the headers and values into the final command in a single allocation.
+"""
+import typing
+from ..exceptions import YKOATHError
+
+def encode_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes((length,))
+    elif length <= 0xff:
+        return bytes((0x81, length))
+    elif length <= 0xffff:
+        return bytes((0x82, length >> 8, length & 0xff))
+    raise YKOATHError("TLV value too long: {} bytes".format(length))
+
+def read_length(data, offset: int) -> typing.Tuple[int, int]:
+    """
+    Decode the length at ``offset``. Returns the length and the offset of the value.
+    """
+    first = data[offset]
+    if first < 0x80:
+        return first, offset + 1
+    size = first & 0x7f
+    if size == 0 or size > 3 or offset + 1 + size > len(data):
+        raise YKOATHError("Invalid TLV length at offset {}".format(offset))
+    return int.from_bytes(data[offset + 1:offset + 1 + size], byteorder="big"), offset + 1 + size
+
+def read(data, offset: int = 0, expect_tag: int = None, short_tags=()) -> typing.Tuple[int, typing.Any, int]:
+    """
+    Decode the TLV at ``offset`` in ``data``. Returns the tag, the value as a slice of ``data`` (a view, not a copy,
+    if ``data`` is a memoryview) and the offset of the next TLV. Tags in ``short_tags`` are followed by a single value
+    byte and no length.
+    """
+    end = len(data)
+    if offset + 2 > end:
+        raise YKOATHError("Truncated TLV at offset {}".format(offset))
+    tag, length = data[offset], data[offset + 1]
+    if expect_tag is not None and tag != expect_tag:
+        raise YKOATHError("Expected TLV tag 0x{:02x}, got 0x{:02x}".format(expect_tag, tag))
+    if tag in short_tags:
+        return tag, data[offset + 1:offset + 2], offset + 2
+    start = offset + 2
+    if length >= 0x80:
+        length, start = read_length(data, offset + 1)
+    offset = start + length
+    if offset > end:
+        raise YKOATHError("Truncated TLV value at offset {}".format(start))
+    return tag, data[start:offset], offset
+
+def iterate(data, short_tags=()) -> typing.Iterator[typing.Tuple[int, memoryview]]:
+    """
+    Yield (tag, value) for each TLV in ``data``, with values as memoryviews into ``data``.
+    """
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    offset, end = 0, len(view)
+    while offset < end:
+        tag, value, offset = read(view, offset, short_tags=short_tags)
+        yield tag, value
+
+def encode(*items) -> bytes:
+    """
+    Encode (tag, value) pairs. A value can be a bytes-like object, a tuple of bytes-like objects that are
+    concatenated, or an int, which is written as a single byte following the tag with no length (the form used for
+    YKOATH properties).
+    """
+    parts = []
+    for tag, value in items:
+        if value.__class__ is int:
+            parts.append(bytes((tag, value)))
+            continue
+        if value.__class__ is tuple:
+            length = sum(map(len, value))
+        else:
+            length, value = len(value), (value,)
+        parts.append(bytes((tag, length)) if length < 0x80 else bytes((tag,)) + encode_length(length))
+        parts.extend(value)
+    return b"".join(parts)